@@ -0,0 +1,39 @@
+import argparse
+import sys
+from library_system import DatabaseManagerSingleton, CassandraBackend, CommandRunner, InMemoryBackend, CONTACT_POINTS
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Run library commands from a script, one per line: add-book, add-user, reserve, prolong, finish.")
+    parser.add_argument('script', nargs='?', default='-', help="file of commands, - reads them from stdin")
+    parser.add_argument('--backend', choices=['cassandra', 'memory'], default='cassandra')
+    parser.add_argument('--contact-points', nargs='+', default=CONTACT_POINTS)
+    parser.add_argument('--concurrency', type=int, default=8, help="commands run at once, the commands of one user always run in order")
+    parser.add_argument('--max-reserved-books', type=int, default=20)
+    parser.add_argument('--logs', action='store_true', help="print the manager's log messages")
+    args = parser.parse_args(argv)
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+    return args
+
+# prints the commands that failed, returns the number of failed commands
+def run_batch(args, lines):
+    backend = InMemoryBackend() if args.backend == 'memory' else None
+    db_manager = DatabaseManagerSingleton(args.contact_points, logs_enabled=args.logs, max_reserved_books=args.max_reserved_books, backend=backend)
+    results = CommandRunner(db_manager, concurrency=args.concurrency).run(lines)
+    failed = 0
+    for line_number, line, succeeded, error in results:
+        if not succeeded:
+            failed += 1
+            print(f"line {line_number}: {line}: {error or 'failed'}", file=sys.stderr)
+    print(f"{len(results) - failed} of {len(results)} commands succeeded", file=sys.stderr)
+    return failed
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.script == '-':
+        failed = run_batch(args, sys.stdin)
+    else:
+        with open(args.script, encoding='utf-8') as file:
+            failed = run_batch(args, file)
+    CassandraBackend.shutdown_shared()
+    sys.exit(1 if failed else 0)
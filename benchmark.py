@@ -0,0 +1,509 @@
+import argparse
+import asyncio
+import collections
+import json
+import multiprocessing
+import queue
+import random
+import sys
+import threading
+import time
+import traceback
+import uuid
+from datetime import datetime, timedelta, timezone
+from library_system import (DatabaseManagerSingleton, AsyncDatabaseManager, CassandraBackend, InMemoryBackend, ClusterConfig, Metrics,
+                            Histogram, CONTACT_POINTS, LWT_QUERIES, parse_due_date)
+
+OPERATIONS = ['make_reservation', 'get_books_by_title', 'update_reservation_due_date', 'finish_reservation']
+DEFAULT_MIX = 'make_reservation=40,get_books_by_title=40,update_reservation_due_date=10,finish_reservation=10'
+
+def parse_mix(mix):
+    weights = {}
+    for item in mix.split(','):
+        name, weight = item.split('=')
+        if name not in OPERATIONS:
+            raise ValueError(f"Unknown operation in mix: {name}")
+        weights[name] = float(weight)
+    return weights
+
+# nearest-rank percentile of an already sorted list
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    index = max(0, int(round(p / 100 * len(sorted_values))) - 1)
+    return sorted_values[min(index, len(sorted_values) - 1)]
+
+def summarize_latencies(latencies):
+    latencies = sorted(latencies)
+    return {
+        'p50': percentile(latencies, 50) * 1000 if latencies else None,
+        'p95': percentile(latencies, 95) * 1000 if latencies else None,
+        'p99': percentile(latencies, 99) * 1000 if latencies else None,
+        'max': latencies[-1] * 1000 if latencies else None,
+    }
+
+# the percentiles of merged worker histograms are estimated within the histogram buckets
+def summarize_histogram(histogram):
+    return {
+        'p50': histogram.quantile(0.5) * 1000 if histogram.count else None,
+        'p95': histogram.quantile(0.95) * 1000 if histogram.count else None,
+        'p99': histogram.quantile(0.99) * 1000 if histogram.count else None,
+        'max': histogram.max * 1000 if histogram.count else None,
+    }
+
+# counts how often each conditional update was not applied and the driver errors of every statement,
+# wraps the manager's execute, execute_async and execute_batch_async
+class StatementCounter():
+    def __init__(self, db_manager):
+        self.lock = threading.Lock()
+        self.attempts = {name: 0 for name in LWT_QUERIES}
+        self.not_applied = {name: 0 for name in LWT_QUERIES}
+        # (statement, exception class) -> count
+        self.errors = collections.Counter()
+        execute = db_manager.execute
+        execute_async = db_manager.execute_async
+        execute_batch_async = db_manager.execute_batch_async
+        def counting_execute(name, params):
+            try:
+                result = execute(name, params)
+            except Exception as e:
+                self.count_error(name, e)
+                raise
+            if name in self.attempts:
+                self.count(name, result.one().applied)
+            return result
+        def counting_execute_async(name, params):
+            future = execute_async(name, params)
+            on_success = (lambda rows: self.count(name, rows[0].applied)) if name in self.attempts else (lambda rows: None)
+            future.add_callbacks(on_success, lambda exception: self.count_error(name, exception))
+            return future
+        def counting_execute_batch_async(name, rows):
+            future = execute_batch_async(name, rows)
+            future.add_callbacks(lambda rows: None, lambda exception: self.count_error(name, exception))
+            return future
+        db_manager.execute = counting_execute
+        db_manager.execute_async = counting_execute_async
+        db_manager.execute_batch_async = counting_execute_batch_async
+    def count(self, name, applied):
+        with self.lock:
+            self.attempts[name] += 1
+            if not applied:
+                self.not_applied[name] += 1
+    def count_error(self, name, exception):
+        with self.lock:
+            self.errors[(name, type(exception).__name__)] += 1
+    def report(self):
+        return {name: {
+            'attempts': self.attempts[name],
+            'not_applied': self.not_applied[name],
+            'not_applied_rate': self.not_applied[name] / self.attempts[name] if self.attempts[name] else None,
+        } for name in LWT_QUERIES}
+    # statement -> exception class -> count
+    def error_report(self):
+        with self.lock:
+            report = {}
+            for (name, error), count in self.errors.items():
+                report.setdefault(name, {})[error] = count
+            return report
+
+class Client():
+    def __init__(self, db_manager, username, books, cum_weights, mix, operations, seed, due_date_str):
+        self.db_manager = db_manager
+        self.username = username
+        self.books = books
+        self.cum_weights = cum_weights
+        self.operation_names = list(mix)
+        self.operation_weights = list(mix.values())
+        self.operations = operations
+        self.random = random.Random(seed)
+        self.due_date_str = due_date_str
+        # a prolongation moves the reservation to another day, so it goes through reservations_by_due_date
+        self.prolonged_due_dates = [(parse_due_date(due_date_str) + timedelta(days=days)).strftime('%d.%m.%Y') for days in range(1, 15)]
+        # books this client holds, so prolong and finish target real reservations
+        self.reserved = []
+        self.latencies = {name: [] for name in OPERATIONS}
+        self.failures = {name: 0 for name in OPERATIONS}
+        self.errors = {name: 0 for name in OPERATIONS}
+    def pick_book(self):
+        return self.random.choices(self.books, cum_weights=self.cum_weights)[0]
+    def pick_reserved(self):
+        if self.reserved:
+            return self.random.choice(self.reserved)
+        return self.pick_book()
+    def run_operation(self, name):
+        if name == 'make_reservation':
+            title, book_id = self.pick_book()
+            if self.db_manager.make_reservation(self.username, title, book_id, self.due_date_str):
+                self.reserved.append((title, book_id))
+                return True
+            return False
+        if name == 'get_books_by_title':
+            title, book_id = self.pick_book()
+            return len(self.db_manager.get_books_by_title(title)) > 0
+        if name == 'update_reservation_due_date':
+            title, book_id = self.pick_reserved()
+            return self.db_manager.update_reservation_due_date(self.username, book_id, self.random.choice(self.prolonged_due_dates))
+        title, book_id = self.pick_reserved()
+        if self.db_manager.finish_reservation(self.username, book_id, title):
+            self.reserved.remove((title, book_id))
+            return True
+        return False
+    def run(self):
+        for _ in range(self.operations):
+            name = self.random.choices(self.operation_names, weights=self.operation_weights)[0]
+            start_time = time.perf_counter()
+            try:
+                succeeded = self.run_operation(name)
+            except Exception:
+                succeeded = False
+                self.errors[name] += 1
+            self.latencies[name].append(time.perf_counter() - start_time)
+            if not succeeded:
+                self.failures[name] += 1
+    # every operation is a make_reservation sent without waiting for the previous one, window bounds those in flight
+    async def run_async(self, async_manager, in_flight):
+        async def reserve():
+            title, book_id = self.pick_book()
+            async with in_flight:
+                start_time = time.perf_counter()
+                try:
+                    succeeded = await async_manager.make_reservation(self.username, title, book_id, self.due_date_str)
+                except Exception:
+                    succeeded = False
+                    self.errors['make_reservation'] += 1
+                self.latencies['make_reservation'].append(time.perf_counter() - start_time)
+            if not succeeded:
+                self.failures['make_reservation'] += 1
+        await asyncio.gather(*[reserve() for _ in range(self.operations)])
+
+def new_db_manager(args, backend, metrics=None):
+    cluster_config = ClusterConfig(local_dc=args.local_dc, pin_to_contact_points=args.pin_to_contact_points,
+                                   speculative_delay=args.speculative_delay, connections_per_host=args.connections_per_host,
+                                   protocol_version=args.protocol_version,
+                                   consistency_profiles=dict(item.split('=', 1) for item in args.consistency))
+    return DatabaseManagerSingleton(args.contact_points, max_reserved_books=args.max_reserved_books, contention_gate=args.contention_gate,
+                                    backend=backend, metrics=metrics, cluster_config=cluster_config)
+
+# requests per node of every manager, managers of one process share the backend that counts them
+def host_request_counts(clients):
+    backends = {id(client.db_manager.backend): client.db_manager.backend for client in clients}
+    counts = collections.Counter()
+    for backend in backends.values():
+        counts.update(backend.host_request_counts())
+    return dict(counts)
+
+def new_backend(args):
+    return InMemoryBackend(latency=args.latency) if args.backend == 'memory' else None
+
+# rank i is picked with weight 1 / (i + 1) ** skew, skew=0 is uniform
+def popularity_weights(num_books, skew):
+    cum_weights = []
+    total = 0
+    for i in range(num_books):
+        total += 1 / (i + 1) ** skew
+        cum_weights.append(total)
+    return cum_weights
+
+# every run gets its own titles and users, so runs against the same keyspace do not interfere
+def add_benchmark_books(args, db_manager, run_id):
+    titles = [f"bench {run_id} book {i}" for i in range(args.books)]
+    book_ids = db_manager.add_books_bulk(((title, "Benchmark Author") for title in titles), progress_every=0)
+    return list(zip(titles, book_ids))
+
+def new_clients(args, db_manager, backend, metrics, books, cum_weights, client_ids, run_id):
+    mix = parse_mix(args.mix)
+    clients = []
+    for i in client_ids:
+        username = f"bench_{run_id}_user_{i}"
+        client_manager = db_manager if args.shared_session else new_db_manager(args, backend, metrics)
+        client_manager.add_user(username)
+        clients.append(Client(client_manager, username, books, cum_weights, mix, args.operations, args.seed + i, args.due_date))
+    return clients
+
+def run_clients(args, clients):
+    if args.window:
+        # one event loop drives every client of this process
+        async def run_all():
+            in_flight = asyncio.Semaphore(args.window)
+            await asyncio.gather(*[client.run_async(AsyncDatabaseManager(client.db_manager), in_flight) for client in clients])
+        asyncio.run(run_all())
+        return
+    threads = [threading.Thread(target=client.run) for client in clients]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+def statement_counters(clients):
+    return [StatementCounter(manager) for manager in {id(client.db_manager): client.db_manager for client in clients}.values()]
+
+# operation -> retries of every manager, counted by the manager's retry loops
+def retry_counts(clients):
+    counts = collections.Counter()
+    for manager in {id(client.db_manager): client.db_manager for client in clients}.values():
+        counts.update(manager.retries)
+    return dict(counts)
+
+def merge_error_reports(reports):
+    errors = {}
+    for report in reports:
+        for name, counts in report.items():
+            merged = errors.setdefault(name, {})
+            for error, count in counts.items():
+                merged[error] = merged.get(error, 0) + count
+    return errors
+
+def merge_lwt_reports(reports):
+    lwt = {}
+    for report in reports:
+        for name, counts in report.items():
+            merged = lwt.setdefault(name, {'attempts': 0, 'not_applied': 0})
+            merged['attempts'] += counts['attempts']
+            merged['not_applied'] += counts['not_applied']
+    for counts in lwt.values():
+        counts['not_applied_rate'] = counts['not_applied'] / counts['attempts'] if counts['attempts'] else None
+    return lwt
+
+def run_benchmark(args):
+    if args.workers:
+        return run_benchmark_workers(args)
+    backend = new_backend(args)
+    metrics = Metrics() if args.metrics else None
+    db_manager = new_db_manager(args, backend, metrics)
+    run_id = uuid.uuid4().hex[:8]
+    books = add_benchmark_books(args, db_manager, run_id)
+    cum_weights = popularity_weights(len(books), args.skew)
+    clients = new_clients(args, db_manager, backend, metrics, books, cum_weights, range(args.clients), run_id)
+    counters = statement_counters(clients)
+
+    started_at = datetime.now(timezone.utc).isoformat()
+    start_time = time.perf_counter()
+    run_clients(args, clients)
+    duration = time.perf_counter() - start_time
+
+    operations = {}
+    for name in OPERATIONS:
+        latencies = [latency for client in clients for latency in client.latencies[name]]
+        failures = sum(client.failures[name] for client in clients)
+        errors = sum(client.errors[name] for client in clients)
+        operations[name] = {
+            'count': len(latencies),
+            'failures': failures,
+            'errors': errors,
+            'failure_rate': failures / len(latencies) if latencies else None,
+            'throughput': len(latencies) / duration,
+            'latency_ms': summarize_latencies(latencies),
+        }
+    total_operations = sum(operation['count'] for operation in operations.values())
+    return {
+        'config': vars(args),
+        'started_at': started_at,
+        'duration_s': duration,
+        'operations_total': total_operations,
+        'throughput': total_operations / duration,
+        'operations': operations,
+        'lwt': merge_lwt_reports(counter.report() for counter in counters),
+        'driver_errors': merge_error_reports(counter.error_report() for counter in counters),
+        'retries': retry_counts(clients),
+        'hosts': host_request_counts(clients),
+        'metrics': metrics.snapshot() if metrics is not None else None,
+    }
+
+# runs in its own process with its own session, so the clients are not limited by one interpreter and one driver event loop,
+# sends back a histogram per operation instead of every latency
+def run_worker(args, worker, books, run_id, barrier, results):
+    try:
+        backend = new_backend(args)
+        metrics = Metrics() if args.metrics else None
+        db_manager = new_db_manager(args, backend, metrics)
+        if backend is not None:
+            # the memory backend lives in this process, so every worker reserves from its own copy of the books
+            db_manager.execute_batch_async('add_book_with_id', [(book_id, title, "Benchmark Author") for title, book_id in books]).result()
+        client_ids = range(worker, args.clients, args.workers)
+        clients = new_clients(args, db_manager, backend, metrics, books, popularity_weights(len(books), args.skew), client_ids, run_id)
+        counters = statement_counters(clients)
+    except Exception:
+        barrier.abort()
+        results.put((worker, None, traceback.format_exc()))
+        return
+    try:
+        barrier.wait()
+    except threading.BrokenBarrierError:
+        results.put((worker, None, "stopped, another worker failed to start"))
+        return
+    run_clients(args, clients)
+
+    operations = {}
+    for name in OPERATIONS:
+        histogram = Histogram()
+        for client in clients:
+            for latency in client.latencies[name]:
+                histogram.observe(latency)
+        operations[name] = {
+            'histogram': histogram,
+            'failures': sum(client.failures[name] for client in clients),
+            'errors': sum(client.errors[name] for client in clients),
+        }
+    results.put((worker, {
+        'operations': operations,
+        'lwt': [counter.report() for counter in counters],
+        'driver_errors': [counter.error_report() for counter in counters],
+        'retries': retry_counts(clients),
+        'hosts': host_request_counts(clients),
+        'metrics': metrics,
+    }, None))
+
+# a worker that dies without reporting, e.g. killed or crashed in the driver, would leave the barrier waiting forever
+def watch_workers(workers, barrier, stopped, poll_interval=1.0):
+    while not stopped.wait(poll_interval):
+        if any(p.exitcode not in (None, 0) for p in workers):
+            barrier.abort()
+            return
+
+# the (worker, result, error) of every worker, raises once a worker has exited without reporting its results
+def collect_worker_results(workers, results, poll_interval=1.0):
+    worker_results = {}
+    while len(worker_results) < len(workers):
+        try:
+            worker, result, error = results.get(timeout=poll_interval)
+            worker_results[worker] = (worker, result, error)
+        except queue.Empty:
+            for worker, p in enumerate(workers):
+                if worker not in worker_results and p.exitcode not in (None, 0):
+                    raise RuntimeError(f"Worker {worker} exited with code {p.exitcode} before reporting its results")
+    return [worker_results[worker] for worker in sorted(worker_results)]
+
+def run_benchmark_workers(args):
+    db_manager = new_db_manager(args, new_backend(args))
+    run_id = uuid.uuid4().hex[:8]
+    books = add_benchmark_books(args, db_manager, run_id)
+    # spawned workers start without the parent's connections, which the driver cannot share across a fork
+    context = multiprocessing.get_context('spawn')
+    barrier = context.Barrier(args.workers + 1)
+    results = context.Queue()
+    workers = [context.Process(target=run_worker, args=(args, worker, books, run_id, barrier, results)) for worker in range(args.workers)]
+    for p in workers:
+        p.start()
+    stopped = threading.Event()
+    threading.Thread(target=watch_workers, args=(workers, barrier, stopped), daemon=True).start()
+    # the clock starts once every worker has connected and added its users
+    try:
+        barrier.wait()
+    except threading.BrokenBarrierError:
+        pass
+    started_at = datetime.now(timezone.utc).isoformat()
+    start_time = time.perf_counter()
+    try:
+        worker_results = collect_worker_results(workers, results)
+    except RuntimeError:
+        # nobody would collect the results of the other workers
+        for p in workers:
+            p.terminate()
+        raise
+    finally:
+        stopped.set()
+    duration = time.perf_counter() - start_time
+    for p in workers:
+        p.join()
+    failed = [error for worker, result, error in worker_results if error is not None]
+    if failed:
+        raise RuntimeError(f"{len(failed)} workers failed:\n" + '\n'.join(failed))
+
+    metrics = Metrics() if args.metrics else None
+    operations = {}
+    for name in OPERATIONS:
+        histogram = Histogram()
+        failures = errors = 0
+        for worker, result, error in worker_results:
+            histogram.merge(result['operations'][name]['histogram'])
+            failures += result['operations'][name]['failures']
+            errors += result['operations'][name]['errors']
+        operations[name] = {
+            'count': histogram.count,
+            'failures': failures,
+            'errors': errors,
+            'failure_rate': failures / histogram.count if histogram.count else None,
+            'throughput': histogram.count / duration,
+            'latency_ms': summarize_histogram(histogram),
+        }
+    if metrics is not None:
+        for worker, result, error in worker_results:
+            metrics.merge(result['metrics'])
+    total_operations = sum(operation['count'] for operation in operations.values())
+    return {
+        'config': vars(args),
+        'started_at': started_at,
+        'duration_s': duration,
+        'operations_total': total_operations,
+        'throughput': total_operations / duration,
+        'operations': operations,
+        'lwt': merge_lwt_reports(report for worker, result, error in worker_results for report in result['lwt']),
+        'driver_errors': merge_error_reports(report for worker, result, error in worker_results for report in result['driver_errors']),
+        'retries': dict(sum((collections.Counter(result['retries']) for worker, result, error in worker_results), collections.Counter())),
+        'hosts': dict(sum((collections.Counter(result['hosts']) for worker, result, error in worker_results), collections.Counter())),
+        'metrics': metrics.snapshot() if metrics is not None else None,
+    }
+
+def print_report(results, file=sys.stderr):
+    print(f"{results['operations_total']} operations in {results['duration_s']:.2f} s, {results['throughput']:.1f} ops/s", file=file)
+    print(f"{'operation':<30}{'count':>8}{'fail %':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}", file=file)
+    for name, operation in results['operations'].items():
+        if not operation['count']:
+            continue
+        latency = operation['latency_ms']
+        print(f"{name:<30}{operation['count']:>8}{operation['failure_rate'] * 100:>8.1f}"
+              f"{latency['p50']:>10.2f}{latency['p95']:>10.2f}{latency['p99']:>10.2f}{latency['max']:>10.2f}", file=file)
+    for name, counts in results['lwt'].items():
+        if counts['attempts']:
+            print(f"LWT {name}: {counts['attempts']} attempts, {counts['not_applied_rate'] * 100:.1f}% not applied", file=file)
+    for name, counts in results['driver_errors'].items():
+        print(f"errors {name}: " + ', '.join(f"{count} {error}" for error, count in sorted(counts.items())), file=file)
+    for name, count in sorted(results['retries'].items()):
+        print(f"retries {name}: {count}", file=file)
+    total_requests = sum(results['hosts'].values())
+    for host, count in sorted(results['hosts'].items()):
+        print(f"host {host}: {count} requests, {count / total_requests * 100:.1f}%", file=file)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the library reservation system.")
+    parser.add_argument('--backend', choices=['cassandra', 'memory'], default='cassandra')
+    parser.add_argument('--contact-points', nargs='+', default=CONTACT_POINTS)
+    parser.add_argument('--latency', type=float, default=0.0, help="simulated round trip of the memory backend in seconds")
+    parser.add_argument('--clients', type=int, default=5)
+    parser.add_argument('--operations', type=int, default=2000, help="operations per client")
+    parser.add_argument('--mix', default=DEFAULT_MIX, help="comma separated operation=weight pairs")
+    parser.add_argument('--books', type=int, default=200)
+    parser.add_argument('--skew', type=float, default=0.0, help="zipf exponent of the book popularity, 0 is uniform")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--max-reserved-books', type=int, default=20)
+    parser.add_argument('--due-date', default="20.06.2024")
+    parser.add_argument('--contention-gate', action='store_true')
+    parser.add_argument('--shared-session', action='store_true', help="all clients share one manager and its caches, the session is shared either way")
+    parser.add_argument('--metrics', action='store_true', help="record per method and per statement histograms")
+    parser.add_argument('--local-dc', help="datacenter to route to, defaults to the one of the first contact point")
+    parser.add_argument('--pin-to-contact-points', action='store_true', help="send requests only to the contact points")
+    parser.add_argument('--speculative-delay', type=float, help="resend reads still running after this many seconds to another replica")
+    parser.add_argument('--connections-per-host', type=int, help="only used with protocol versions 1 and 2")
+    parser.add_argument('--protocol-version', type=int)
+    parser.add_argument('--consistency', nargs='+', default=[], metavar='PROFILE=VALUE',
+                        help="override consistency profiles, e.g. lwt=lwt-local strong-read=ONE strong-write=QUORUM")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="spread the clients over this many processes, each with its own session, 0 runs them in this process")
+    parser.add_argument('--window', type=int, default=0,
+                        help="send make_reservation without waiting, with up to this many in flight per process, 0 runs a thread per client")
+    parser.add_argument('--output', help="write the results as json to this file")
+    args = parser.parse_args(argv)
+    if args.window and set(parse_mix(args.mix)) != {'make_reservation'}:
+        parser.error("--window only runs make_reservation, use --mix make_reservation=1")
+    return args
+
+if __name__ == "__main__":
+    args = parse_args()
+    results = run_benchmark(args)
+    CassandraBackend.shutdown_shared()
+    print_report(results)
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
@@ -1,17 +1,51 @@
+import asyncio
+import bisect
+import collections
+import contextlib
+import csv
+import io
+import itertools
+import json
+import os
+import pickle
+import queue
+import shlex
+import statistics
+import sys
+from collections import namedtuple, OrderedDict
+import uuid
 import threading
 import random
 import time
 import unittest
-from cassandra.cluster import Cluster, NoHostAvailable
+import unittest.mock
+import zlib
+from cassandra import WriteTimeout, ReadTimeout, Unavailable, OperationTimedOut, WriteType
+from cassandra.cluster import Cluster, NoHostAvailable, ExecutionProfile, EXEC_PROFILE_DEFAULT
+from cassandra.policies import (TokenAwarePolicy, DCAwareRoundRobinPolicy, WhiteListRoundRobinPolicy, WrapperPolicy,
+                                ConstantSpeculativeExecutionPolicy, HostDistance, SimpleConvictionPolicy)
 from cassandra.metadata import KeyspaceMetadata
-from cassandra.query import SimpleStatement, ConsistencyLevel
-from datetime import datetime, timezone
+from cassandra.pool import Host
+from cassandra.connection import DefaultEndPoint
+from cassandra.query import SimpleStatement, ConsistencyLevel, BatchStatement, BatchType, named_tuple_factory
+from datetime import datetime, timedelta, timezone
 import time
 
+CONTACT_POINTS = ['127.0.1.1', '127.0.1.2', '127.0.1.3']
+
 class ExampleTest(unittest.TestCase):
+    # LIBRARY_BACKEND=memory runs the tests without a cluster, on one InMemoryBackend shared by every manager of a test
+    def setUp(self):
+        self.backend = InMemoryBackend(latency=0.001) if os.environ.get('LIBRARY_BACKEND') == 'memory' else None
+    @classmethod
+    def tearDownClass(cls):
+        CassandraBackend.shutdown_shared()
+    def new_db_manager(self, contact_points=CONTACT_POINTS, **kwargs):
+        return DatabaseManagerSingleton(contact_points, backend=self.backend, **kwargs)
+
     def test_stress_1(self):
         start_time = time.time()
-        db_manager = DatabaseManagerSingleton(['127.0.1.1', '127.0.1.2', '127.0.1.3'])
+        db_manager = self.new_db_manager()
         username = "test_user"
         book_title = "Test Book"
         due_date_str = "20.06.2024"
@@ -50,26 +84,640 @@ class ExampleTest(unittest.TestCase):
         print(f"Test 1 Execution time: {end_time - start_time} seconds")
         self.assertEqual(succesfull_reservations, 1)
 
-    # adds speciifed number of books and returns their titles
-    def add_some_books(self, num_books):
-        db_manager = DatabaseManagerSingleton(['127.0.1.1', '127.0.1.2', '127.0.1.3'])
-        book_titles = []
+    # compares per-call SimpleStatement parsing with the prepared statement registry
+    def test_prepared_statements_benchmark(self, num_requests=2000):
+        db_manager = self.new_db_manager()
+        if not isinstance(db_manager.backend, CassandraBackend):
+            self.skipTest("needs a cluster")
+        book_title = "Benchmark Book"
+        db_manager.add_book(book_title, "Test Author")
+        book_id = db_manager.get_books_by_title(book_title)[0].book_id
+
+        start_time = time.time()
+        for _ in range(num_requests):
+            query = SimpleStatement("SELECT * FROM books WHERE title = %s AND book_id = %s", consistency_level=ConsistencyLevel.TWO)
+            simple_book = db_manager.backend.session.execute(query, (book_title, book_id)).one()
+        simple_time = time.time() - start_time
+
+        start_time = time.time()
+        for _ in range(num_requests):
+            prepared_book = db_manager.get_book(book_title, book_id)
+        prepared_time = time.time() - start_time
+
+        print(f"SimpleStatement: {simple_time} seconds, {num_requests / simple_time} requests/s")
+        print(f"Prepared statement: {prepared_time} seconds, {num_requests / prepared_time} requests/s")
+        self.assertEqual(simple_book, prepared_book)
+
+    # the same request as stress test 1, sharing one event loop and one session instead of a thread per request
+    def test_stress_1_async(self, num_requests=10000, max_in_flight=1024):
+        start_time = time.time()
+        db_manager = self.new_db_manager()
+        async_manager = AsyncDatabaseManager(db_manager)
+        username = "test_user_async"
+        book_title = "Test Book Async"
+        due_date_str = "20.06.2024"
+
+        db_manager.add_book(book_title, "Test Author")
+        book_id = db_manager.get_books_by_title(book_title)[0].book_id
+        db_manager.add_user(username)
+
+        async def make_reservations():
+            in_flight = asyncio.Semaphore(max_in_flight)
+            async def make_reservation():
+                async with in_flight:
+                    return await async_manager.make_reservation(username, book_title, book_id, due_date_str)
+            return await asyncio.gather(*[make_reservation() for _ in range(num_requests)])
+
+        results = asyncio.run(make_reservations())
+        end_time = time.time()
+        print(f"Test 1 async Execution time: {end_time - start_time} seconds")
+        self.assertEqual(sum(results), 1)
+
+    # stress test 1 without the delay between requests, losers should not reach Paxos
+    def test_stress_1_contention_gate(self, num_threads=1000):
+        db_manager = self.new_db_manager(contention_gate=True)
+        username = "test_user_gate"
+        book_title = "Test Book Gate"
+        db_manager.add_book(book_title, "Test Author")
+        book_id = db_manager.get_books_by_title(book_title)[0].book_id
+        db_manager.add_user(username)
+
+        lwt_count = 0
+        results = []
+        lock = threading.Lock()
+        execute = db_manager.execute
+        def counting_execute(name, params):
+            nonlocal lwt_count
+            if name == 'lock_book':
+                with lock:
+                    lwt_count += 1
+            return execute(name, params)
+        db_manager.execute = counting_execute
+
+        start_time = time.time()
+        threads = [threading.Thread(target=lambda: results.append(db_manager.make_reservation(username, book_title, book_id, "20.06.2024"))) for _ in range(num_threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        end_time = time.time()
+        print(f"Contention gate Execution time: {end_time - start_time} seconds, conditional updates: {lwt_count}")
+        self.assertEqual(sum(results), 1)
+        self.assertLess(lwt_count, num_threads)
+
+    # the pre-checks make_reservation used to run before the conditional updates, kept for comparison
+    def make_reservation_with_prechecks(self, db_manager, username, book_title, book_id, due_date_str):
+        if not db_manager.check_username_exists(username):
+            return False
+        if db_manager.check_user_reserved_books(username) >= db_manager.max_reserved_books:
+            return False
+        book = db_manager.get_book(book_title, book_id)
+        if not book or not book.available:
+            return False
+        reservation_id = uuid.uuid4()
+        if not db_manager.lock_book(book_id, book_title, username, reservation_id):
+            return False
+        if not db_manager.increment_user_reserved_books(username):
+            db_manager.unlock_book(book_id, book_title, reservation_id)
+            return False
+        # the same writes as make_reservation, so only the checks differ
+        if not db_manager.record_reservations(username, [(book_title, book_id)], [reservation_id], parse_due_date(due_date_str)):
+            db_manager.compensate_reservation(username, book_title, book_id, reservation_id, slot_reserved=True)
+            return False
+        return True
+
+    # counts the round trips of every step, sent synchronously, asynchronously or as a batch,
+    # and compares the median latency per reservation
+    def test_reservation_round_trips(self, num_requests=500):
+        db_manager = self.new_db_manager(max_reserved_books=num_requests)
+        due_date_str = "20.06.2024"
+        step_counts = collections.Counter()
+        def counting(execute):
+            def counting_execute(name, params):
+                step_counts[name] += 1
+                return execute(name, params)
+            return counting_execute
+        methods = ('execute', 'execute_async', 'execute_batch_async')
+
+        for username, reserve in [('round_trips_prechecks', lambda *args: self.make_reservation_with_prechecks(db_manager, *args)),
+                                  ('round_trips_lean', db_manager.make_reservation)]:
+            db_manager.add_user(username)
+            books = []
+            for i in range(num_requests):
+                book_title = f"{username} book {i}"
+                db_manager.add_book(book_title, "Test Author")
+                books.append((book_title, db_manager.get_books_by_title(book_title)[0].book_id))
+
+            step_counts.clear()
+            for method in methods:
+                setattr(db_manager, method, counting(getattr(db_manager, method)))
+            latencies = []
+            for book_title, book_id in books:
+                start_time = time.time()
+                self.assertTrue(reserve(username, book_title, book_id, due_date_str))
+                latencies.append(time.time() - start_time)
+            for method in methods:
+                delattr(db_manager, method)
+
+            print(f"{username}: median latency {statistics.median(latencies) * 1000} ms")
+            for name, count in sorted(step_counts.items()):
+                print(f"    {name}: {count / num_requests} per reservation")
+            statements = sum(step_counts.values()) / num_requests
+            paxos_rounds = sum(count for name, count in step_counts.items() if name in LWT_QUERIES) / num_requests
+            print(f"    {statements} statements and {paxos_rounds} Paxos rounds per reservation")
+            for name in ('add_pending_lock', 'add_reservation', 'add_reservation_by_due_date'):
+                self.assertEqual(step_counts[name], num_requests)
+
+    def test_shared_session(self):
+        if self.backend is not None:
+            self.skipTest("needs a cluster")
+        db_manager_1 = self.new_db_manager()
+        db_manager_2 = self.new_db_manager(list(reversed(CONTACT_POINTS)))
+        self.assertIs(db_manager_1.backend, db_manager_2.backend)
+        self.assertIsNot(db_manager_1.backend, self.new_db_manager(['127.0.1.1']).backend)
+
+    def test_host_routing(self):
+        hosts = [Host(DefaultEndPoint(address), SimpleConvictionPolicy) for address in CONTACT_POINTS]
+        policy = ClusterConfig(pin_to_contact_points=True, token_aware=False).load_balancing_policy(CONTACT_POINTS[1:2])
+        policy.populate(None, hosts)
+        for _ in range(3):
+            self.assertEqual([host.address for host in policy.make_query_plan()], CONTACT_POINTS[1:2])
+        self.assertEqual(policy.counts(), {CONTACT_POINTS[1]: 3})
+        if self.backend is not None:
+            return
+        # without pinning the reads are spread over the whole ring
+        db_manager = self.new_db_manager(cluster_config=ClusterConfig(speculative_delay=0.05))
+        for i in range(100):
+            db_manager.get_book(f"Routing Book {i}", uuid.uuid4())
+        self.assertEqual(len(db_manager.host_request_counts()), len(CONTACT_POINTS))
+
+    def test_consistency_profiles(self):
+        config = ClusterConfig(consistency_profiles={'lwt': 'lwt-local', 'strong-read': 'ONE', 'strong-write': 'QUORUM/LOCAL_SERIAL'})
+        levels = config.consistency_levels()
+        self.assertEqual(levels['lwt'], (ConsistencyLevel.LOCAL_QUORUM, ConsistencyLevel.LOCAL_SERIAL))
+        self.assertEqual(levels['strong-read'], (ConsistencyLevel.ONE, None))
+        self.assertEqual(levels['strong-write'], (ConsistencyLevel.QUORUM, ConsistencyLevel.LOCAL_SERIAL))
+        self.assertEqual(levels['fast-read'], CONSISTENCY_PROFILES['fast-read'])
+        # managers with different levels do not share a backend
+        self.assertNotEqual(config.key(), ClusterConfig().key())
+        with self.assertRaises(Exception):
+            ClusterConfig(consistency_profiles={'lwt': 'NOT_A_LEVEL'})
+        with self.assertRaises(Exception):
+            ClusterConfig(consistency_profiles={'no-such-profile': 'ONE'})
+        self.assertTrue(all(profile in CONSISTENCY_PROFILES for query, profile in QUERIES.values()))
+
+    def test_search_books(self):
+        db_manager = self.new_db_manager()
+        db_manager.add_books_bulk([("Search Saga", "Test Author")] * 3 + [("search saga II", "Test Author")] * 2 + [("Other", "Test Author")], progress_every=0)
+        self.assertEqual(db_manager.find_titles("SEARCH sa"), ["Search Saga", "search saga II"])
+        self.assertEqual(db_manager.find_titles("search saga i"), ["search saga II"])
+
+        pages = list(db_manager.search_books("search", page_size=2))
+        self.assertEqual([len(books) for books, cursor in pages], [2, 1, 2])
+        self.assertIsNone(pages[-1][1])
+        # resuming from the first cursor yields the remaining pages
+        resumed = list(db_manager.search_books("search", page_size=2, cursor=pages[0][1]))
+        self.assertEqual([[book.book_id for book in books] for books, cursor in resumed], [[book.book_id for book in books] for books, cursor in pages[1:]])
+
+    def test_row_factory(self):
+        # rows of known columns become value objects only when read, other rows stay named tuples
+        rows = library_row_factory(BOOK_COLUMNS, [(uuid.uuid4(), "Row Book", "Test Author", True) for _ in range(3)])
+        self.assertIsInstance(rows, LazyRows)
+        self.assertEqual(len(rows[1:]), 2)
+        self.assertEqual(rows[0].title, "Row Book")
+        self.assertFalse(hasattr(rows[0], '__dict__'))
+        self.assertEqual(library_row_factory(('applied',), [(True,)])[0].applied, True)
+
+        db_manager = self.new_db_manager(book_cache_size=0)
+        username = "row_user"
+        db_manager.add_user(username)
+        db_manager.add_book("Row Book", "Test Author")
+        book = db_manager.get_books_by_title("Row Book")[0]
+        self.assertIsInstance(book, Book)
+        self.assertTrue(db_manager.make_reservation(username, book.title, book.book_id, "20.06.2024"))
+        reservation, = db_manager.get_user_reserved_books(username)
+        self.assertIsInstance(reservation, Reservation)
+        self.assertEqual((reservation.book.author, reservation.due_date), ("Test Author", _to_timestamp(parse_due_date("20.06.2024"))))
+
+    def test_command_runner(self, num_users=8):
+        db_manager = self.new_db_manager()
+        book_ids = db_manager.add_books_bulk([("Batch Book", "Test Author")] * num_users, progress_every=0)
+        script = [f"add-user batch_user_{i}\nreserve batch_user_{i} 'Batch Book' 20.06.2024\n" for i in range(num_users)]
+        results = CommandRunner(db_manager, concurrency=4).run(''.join(script).splitlines())
+        self.assertTrue(all(succeeded for line_number, line, succeeded, error in results))
+        reserved = [db_manager.get_user_reserved_books(f"batch_user_{i}", with_books=False)[0].book_id for i in range(num_users)]
+        self.assertEqual(sorted(reserved), sorted(book_ids))
+
+        book_id = reserved[0]
+        script = ["# returns", f"prolong batch_user_0 {book_id} 27.06.2024", f"finish batch_user_0 'Batch Book' {book_id}",
+                  f"finish batch_user_0 'Batch Book' {book_id}", "", "lend batch_user_0", "finish batch_user_0 'Batch Book' 42"]
+        results = CommandRunner(db_manager, concurrency=2).run(script)
+        self.assertEqual([(line_number, succeeded) for line_number, line, succeeded, error in results], [(2, True), (3, True), (4, False), (6, False), (7, False)])
+        self.assertEqual(results[3][3], "Unknown command: lend")
+        self.assertTrue(db_manager.get_book("Batch Book", book_id).available)
+
+    def test_menu_loop(self):
+        # a long session of choices does not grow the stack
+        menu_dialog = MenuDialogSingleton(self.new_db_manager())
+        choices = ["0"] * (sys.getrecursionlimit() + 10) + ["5"]
+        with unittest.mock.patch('builtins.input', side_effect=choices), contextlib.redirect_stdout(io.StringIO()):
+            menu_dialog.show_menu()
+
+    # returns and reservations of the same user race each other, the counter must match the reservations
+    def test_stress_finish(self, num_books=20, rounds=10):
+        db_manager = self.new_db_manager(max_reserved_books=num_books)
+        username = "finish_user"
+        db_manager.add_user(username)
+        book_ids = db_manager.add_books_bulk([(f"Finish Book {i}", "Test Author") for i in range(num_books)], progress_every=0)
+        books = [(f"Finish Book {i}", book_id) for i, book_id in enumerate(book_ids)]
+        for book_title, book_id in books:
+            self.assertTrue(db_manager.make_reservation(username, book_title, book_id, "20.06.2024"))
+
+        finished = []
+        def return_and_reserve(book_title, book_id):
+            for _ in range(rounds):
+                # two returns of the same book, only one of them counts
+                results = [db_manager.finish_reservation(username, book_id, book_title) for _ in range(2)]
+                finished.append(sum(results))
+                db_manager.make_reservation(username, book_title, book_id, "20.06.2024")
+        threads = [threading.Thread(target=return_and_reserve, args=book) for book in books]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(set(finished), {1})
+        reservations = db_manager.get_user_reserved_books(username, with_books=False)
+        self.assertEqual(db_manager.check_user_reserved_books(username), len(reservations))
+        due = [row for rows in db_manager.get_overdue_reservations(as_of=parse_due_date("21.06.2024")) for row in rows]
+        self.assertEqual(sorted(row.book_id for row in due), sorted(row.book_id for row in reservations))
+
+    # every return reads the reservation before any of them deletes it, and a return comes between the read and the update
+    # of a prolongation, the conditional statements then find no row and return [applied] alone
+    def test_finish_races(self, num_threads=8):
+        if self.backend is None:
+            self.skipTest("holds back the reads of the memory backend")
+        hooks = []
+        class RacingBackend(InMemoryBackend):
+            def execute(self, name, params):
+                rows = super().execute(name, params)
+                if name == 'get_reservation' and hooks:
+                    hooks.pop(0)()
+                return rows
+        db_manager = DatabaseManagerSingleton(backend=RacingBackend())
+        username = "race_user"
+        book_title = "Race Book"
+        db_manager.add_user(username)
+        book_id = db_manager.add_books_bulk([(book_title, "Test Author")], progress_every=0)[0]
+
+        self.assertTrue(db_manager.make_reservation(username, book_title, book_id, "20.06.2024"))
+        barrier = threading.Barrier(num_threads)
+        hooks.extend([barrier.wait] * num_threads)
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(db_manager.finish_reservation(username, book_id, book_title))) for _ in range(num_threads)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(results), [False] * (num_threads - 1) + [True])
+        self.assertEqual(db_manager.check_user_reserved_books(username), 0)
+
+        self.assertTrue(db_manager.make_reservation(username, book_title, book_id, "20.06.2024"))
+        hooks.append(lambda: self.assertTrue(db_manager.finish_reservation(username, book_id, book_title)))
+        self.assertFalse(db_manager.update_reservation_due_date(username, book_id, "25.06.2024"))
+        self.assertEqual(list(db_manager.get_overdue_reservations(as_of=parse_due_date("26.06.2024"))), [])
+        self.assertEqual(db_manager.find_available_book(book_title), book_id)
+
+    def test_metrics(self):
+        metrics = Metrics()
+        db_manager = self.new_db_manager(metrics=metrics)
+        username = "metrics_user"
+        book_title = "Metrics Book"
+        db_manager.add_book(book_title, "Test Author")
+        db_manager.add_user(username)
+        book_id = db_manager.get_books_by_title(book_title)[0].book_id
+        self.assertTrue(db_manager.make_reservation(username, book_title, book_id, "20.06.2024"))
+        self.assertFalse(db_manager.make_reservation(username, book_title, book_id, "20.06.2024"))
+
+        snapshot = metrics.snapshot()
+        self.assertEqual(snapshot['methods']['make_reservation']['count'], 2)
+        self.assertEqual(snapshot['methods']['lock_book']['count'], 2)
+        self.assertEqual(snapshot['statements']['add_reservation']['count'], 1)
+        self.assertEqual(snapshot['lwt']['lock_book:applied'], 1)
+        self.assertEqual(snapshot['lwt']['lock_book:not_applied'], 1)
+        self.assertIn('library_lwt_total{statement="lock_book",applied="false"} 1', metrics.prometheus_text())
+
+    # failures are injected into the memory backend, a statement that timed out may still have been applied
+    def test_reservation_compensation(self):
+        if self.backend is None:
+            self.skipTest("injects failures into the memory backend")
+        faults = {}
+        class FaultyBackend(InMemoryBackend):
+            def execute(self, name, params):
+                if faults.get(name):
+                    error, applied = faults[name].pop(0)
+                    if applied:
+                        super().execute(name, params)
+                    raise error
+                return super().execute(name, params)
+            def execute_async(self, name, params):
+                try:
+                    return InMemoryFuture(self.execute(name, params))
+                except Exception as e:
+                    return InMemoryFuture(exception=e)
+        db_manager = DatabaseManagerSingleton(backend=FaultyBackend(), retry_policy=RetryPolicy(base_delay=0.001))
+        username = "compensation_user"
+        db_manager.add_user(username)
+        book_ids = db_manager.add_books_bulk([("Compensation Book", "Test Author")] * 3, progress_every=0)
+        def available(book_id):
+            return db_manager.execute('get_book_lock', ("Compensation Book", book_id)).one().available
+
+        # the increment took the slot but timed out, the book is released and the user left for the sweeper
+        faults['increment_user_reserved_books'] = [(WriteTimeout("timed out", write_type=WriteType.SIMPLE), True)]
+        self.assertFalse(db_manager.make_reservation(username, "Compensation Book", book_ids[0], "20.06.2024"))
+        self.assertTrue(available(book_ids[0]))
+        self.assertIn(username, db_manager.users_to_reconcile)
+        self.assertEqual([row.username for row in db_manager.execute('get_users_to_reconcile', ())], [username])
+
+        # the insert keeps failing, the slot and the book are given back
+        faults['add_reservation'] = [(Unavailable("no replicas"), False)] * db_manager.retry_policy.max_attempts
+        self.assertFalse(db_manager.make_reservation(username, "Compensation Book", book_ids[1], "20.06.2024"))
+        self.assertTrue(available(book_ids[1]))
+        self.assertEqual(db_manager.check_user_reserved_books(username), 1)
+        self.assertEqual(db_manager.retries['record_reservations'], db_manager.retry_policy.max_attempts - 1)
+
+
+        # the lock was applied before it timed out, the serial read finds our reservation id on it
+        faults['lock_book'] = [(OperationTimedOut(), True)]
+        faults['increment_user_reserved_books'] = [(Unavailable("no replicas"), False)]
+        self.assertTrue(db_manager.make_reservation(username, "Compensation Book", book_ids[1], "20.06.2024"))
+
+        # a lock whose reservation never got written is released once the grace period is over
+        self.assertTrue(db_manager.lock_book(book_ids[2], "Compensation Book", username, uuid.uuid4()))
+        # the sweeper of a restarted process, the user to reconcile is read from the table
+        db_manager.users_to_reconcile.clear()
+        self.assertEqual(ReservationSweeper(DatabaseManagerSingleton(backend=db_manager.backend), grace_period=0).sweep(), (1, 1, 0))
+        self.assertFalse(db_manager.execute('get_users_to_reconcile', ()))
+        self.assertTrue(available(book_ids[2]))
+        self.assertFalse(available(book_ids[1]))
+        self.assertEqual(db_manager.check_user_reserved_books(username), 1)
+
+        # the insert was applied before it timed out, the retry finds the row of this reservation in the way
+        book_id, = db_manager.add_books_bulk([("Compensation Extra", "Test Author")], progress_every=0)
+        faults['add_reservation'] = [(WriteTimeout("timed out", write_type=WriteType.CAS), True)]
+        self.assertTrue(db_manager.make_reservation(username, "Compensation Extra", book_id, "20.06.2024"))
+        self.assertTrue(db_manager.finish_reservation(username, book_id, "Compensation Extra"))
+
+        # a row left behind by another reservation of the book is not overwritten, the book and the slot are given back
+        db_manager.execute('add_reservation', (username, book_id, "Compensation Extra", parse_due_date("01.01.2024"), uuid.uuid4()))
+        self.assertFalse(db_manager.make_reservation(username, "Compensation Extra", book_id, "20.06.2024"))
+        self.assertTrue(db_manager.get_book("Compensation Extra", book_id).available)
+        self.assertEqual(db_manager.check_user_reserved_books(username), 1)
+        self.assertEqual(db_manager.execute('get_reservation', (username, book_id)).one().due_date, _to_timestamp(parse_due_date("01.01.2024")))
+
+        # only the pending locks are read, a lock taken without a username is released too once the grace period is over
+        self.assertTrue(db_manager.lock_book(book_id, "Compensation Extra"))
+        self.assertEqual(ReservationSweeper(db_manager).sweep(), (0, 0, 0))
+        self.assertEqual(ReservationSweeper(db_manager, grace_period=0).sweep(), (1, 0, 0))
+        self.assertTrue(db_manager.get_book("Compensation Extra", book_id).available)
+        # a lock whose pending lock cannot be written would be invisible to the sweeper, it is given back
+        faults['add_pending_lock'] = [(Unavailable("no replicas"), False)] * (db_manager.retry_policy.max_attempts + 1)
+        self.assertFalse(db_manager.lock_book(book_id, "Compensation Extra", username, uuid.uuid4()))
+        self.assertTrue(db_manager.get_book("Compensation Extra", book_id).available)
 
-        for i in range(num_books):
-            book_title = f"Test Book {i+1}"
-            db_manager.add_book(book_title, "Test Author")
-            book_titles.append(book_title)
+        # the pending locks are left to expire, a sweep reads them again without releasing anything
+        self.assertEqual(ReservationSweeper(db_manager, grace_period=0).sweep(), (0, 0, 0))
 
+        # the decrement of a return times out, the book is given back all the same and the user left for the sweeper
+        return_id, = db_manager.add_books_bulk([("Compensation Return", "Test Author")], progress_every=0)
+        self.assertTrue(db_manager.make_reservation(username, "Compensation Return", return_id, "20.06.2024"))
+        faults['set_user_reserved_books'] = [(WriteTimeout("timed out", write_type=WriteType.CAS), False)]
+        self.assertTrue(db_manager.finish_reservation(username, return_id, "Compensation Return"))
+        self.assertIn(username, db_manager.users_to_reconcile)
+        self.assertEqual(db_manager.find_available_book("Compensation Return"), return_id)
+        ReservationSweeper(db_manager).reconcile_users()
+        self.assertFalse(db_manager.users_to_reconcile)
+
+        # the async path compensates the same way: the insert keeps failing, the slot and the book are given back
+        async_manager = AsyncDatabaseManager(db_manager)
+        reserved_books = db_manager.check_user_reserved_books(username)
+        faults['add_reservation'] = [(Unavailable("no replicas"), False)] * (db_manager.retry_policy.max_attempts + 1)
+        self.assertFalse(asyncio.run(async_manager.make_reservation(username, "Compensation Return", return_id, "20.06.2024")))
+        self.assertEqual(db_manager.check_user_reserved_books(username), reserved_books)
+        self.assertTrue(db_manager.get_book("Compensation Return", return_id).available)
+        # the lock was applied before it timed out, the serial read finds our reservation id on it
+        faults['lock_book'] = [(WriteTimeout("timed out", write_type=WriteType.CAS), True)]
+        self.assertTrue(asyncio.run(async_manager.make_reservation(username, "Compensation Return", return_id, "20.06.2024")))
+        self.assertEqual(db_manager.check_user_reserved_books(username), reserved_books + 1)
+        self.assertEqual(db_manager.check_user_reserved_books(username), len(db_manager.get_user_reserved_books(username, with_books=False)))
+
+    # the user of a reservation between its increment and its insert is not recounted, that would free the slot it took
+    def test_reconcile_during_reservation(self):
+        if self.backend is None:
+            self.skipTest("sweeps from within the memory backend")
+        hooks = []
+        class SweepingBackend(InMemoryBackend):
+            def execute(self, name, params):
+                rows = super().execute(name, params)
+                if name == 'increment_user_reserved_books' and hooks:
+                    hooks.pop(0)()
+                return rows
+        db_manager = DatabaseManagerSingleton(backend=SweepingBackend(), max_reserved_books=1)
+        username = "reconcile_user"
+        db_manager.add_user(username)
+        book_ids = db_manager.add_books_bulk([("Reconcile Book", "Test Author")] * 2, progress_every=0)
+        db_manager.mark_user_to_reconcile(username)
+
+        swept = []
+        hooks.append(lambda: swept.append(ReservationSweeper(db_manager).reconcile_users()))
+        self.assertTrue(db_manager.make_reservation(username, "Reconcile Book", book_ids[0], "20.06.2024"))
+        self.assertEqual(swept, [0])
+        self.assertIn(username, db_manager.users_to_reconcile)
+        self.assertFalse(db_manager.make_reservation(username, "Reconcile Book", book_ids[1], "20.06.2024"))
+        self.assertEqual(db_manager.check_user_reserved_books(username), 1)
+
+        # once the reservation is written the user is recounted
+        self.assertEqual(ReservationSweeper(db_manager).reconcile_users(), 0)
+        self.assertNotIn(username, db_manager.users_to_reconcile)
+
+    def test_make_reservations(self):
+        db_manager = self.new_db_manager(max_reserved_books=3)
+        username = "basket_user"
+        db_manager.add_user(username)
+        book_ids = db_manager.add_books_bulk([("Basket Book", "Test Author")] * 5, progress_every=0)
+        books = [("Basket Book", book_id) for book_id in book_ids]
+        self.assertTrue(db_manager.lock_book(book_ids[1], "Basket Book"))
+
+        # the locked book fails, the books past the three free slots are never locked
+        self.assertEqual(db_manager.make_reservations(username, books, "20.06.2024"), [True, False, True, False, False])
+        self.assertEqual(db_manager.check_user_reserved_books(username), 2)
+        self.assertEqual(sorted(reservation.book_id for reservation in db_manager.get_user_reserved_books(username)),
+                         sorted([book_ids[0], book_ids[2]]))
+        self.assertTrue(db_manager.get_book("Basket Book", book_ids[3]).available and db_manager.get_book("Basket Book", book_ids[4]).available)
+        self.assertEqual(db_manager.make_reservations("no_such_user", books, "20.06.2024"), [False] * 5)
+
+        # the conditional insert of the basket is not applied when one of its rows is in the way, every book is given back
+        db_manager.unlock_book(book_ids[1], "Basket Book")
+        db_manager.add_user("basket_user_2")
+        db_manager.execute('add_reservation', ("basket_user_2", book_ids[4], "Basket Book", parse_due_date("01.01.2024"), uuid.uuid4()))
+        self.assertEqual(db_manager.make_reservations("basket_user_2", [books[1], books[4]], "20.06.2024"), [False, False])
+        self.assertTrue(db_manager.get_book("Basket Book", book_ids[1]).available and db_manager.get_book("Basket Book", book_ids[4]).available)
+        self.assertEqual(db_manager.check_user_reserved_books("basket_user_2"), 0)
+
+        # the slots could not be taken, the locked books are given back before the error is raised
+        def lost_every_race(username, count, reserved_books=None):
+            raise Exception("Failed to reserve books")
+        db_manager.reserve_user_slots = lost_every_race
+        with self.assertRaises(Exception):
+            db_manager.make_reservations("basket_user_2", [books[1], books[4]], "20.06.2024")
+        self.assertTrue(db_manager.get_book("Basket Book", book_ids[1]).available and db_manager.get_book("Basket Book", book_ids[4]).available)
+
+    def test_find_available_book(self, num_copies=10):
+        db_manager = self.new_db_manager()
+        book_title = "Popular Book"
+        book_ids = db_manager.add_books_bulk([(book_title, "Test Author")] * num_copies, progress_every=0)
+        self.assertIn(db_manager.find_available_book(book_title), book_ids)
+        self.assertIsNone(db_manager.find_available_book("Missing Book"))
+
+        # every caller gets its own copy, losing a race moves on to another candidate
+        with self.assertRaises(Exception):
+            db_manager.find_available_book(book_title, lock=True)
+        found = {}
+        def find_and_lock(i):
+            reservation_id = uuid.uuid4()
+            book_id = self.new_db_manager().find_available_book(book_title, lock=True, username=f"finder{i}", reservation_id=reservation_id)
+            found[book_id] = reservation_id
+        threads = [threading.Thread(target=find_and_lock, args=(i,)) for i in range(num_copies)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(sorted(found), sorted(book_ids))
+        self.assertIsNone(db_manager.find_available_book(book_title, lock=True, username="finder", reservation_id=uuid.uuid4()))
+
+        # the lock is handed to make_reservation, a failed reservation gives it back
+        self.assertTrue(db_manager.add_user("finder0"))
+        self.assertTrue(db_manager.make_reservation("finder0", book_title, book_ids[0], "31.12.2025", found[book_ids[0]]))
+        self.assertEqual(db_manager.execute('get_reservation', ("finder0", book_ids[0])).one().reservation_id, found[book_ids[0]])
+        self.assertFalse(db_manager.make_reservation("nobody", book_title, book_ids[1], "31.12.2025", found[book_ids[1]]))
+        self.assertEqual(db_manager.find_available_book(book_title), book_ids[1])
+
+    # histograms of worker processes are pickled, sent back and merged into one report
+    def test_histogram_merge(self):
+        histograms = [Histogram() for _ in range(2)]
+        for i, value in enumerate([0.0002, 0.0004, 0.003, 0.004, 0.02, 30.0]):
+            histograms[i % 2].observe(value)
+        merged = Histogram()
+        for h in histograms:
+            merged.merge(pickle.loads(pickle.dumps(h)))
+        self.assertEqual(merged.count, 6)
+        self.assertEqual(merged.max, 30.0)
+        self.assertAlmostEqual(merged.quantile(0.5), 0.0025 + 0.0025 * 1 / 2)
+        self.assertEqual(merged.quantile(1.0), 30.0)
+        metrics = Metrics()
+        metrics.observe_method('make_reservation', 0.001)
+        merged_metrics = Metrics()
+        merged_metrics.merge(pickle.loads(pickle.dumps(metrics)))
+        self.assertEqual(merged_metrics.snapshot()['methods']['make_reservation']['count'], 1)
+
+    def test_overdue_reservations(self):
+        db_manager = self.new_db_manager()
+        username = "overdue_user"
+        db_manager.add_user(username)
+        book_ids = db_manager.add_books_bulk([("Overdue Book", "Test Author")] * 4, progress_every=0)
+        for book_id, due_date_str in zip(book_ids, ["01.03.2024", "01.03.2024", "05.03.2024", "20.03.2024"]):
+            self.assertTrue(db_manager.make_reservation(username, "Overdue Book", book_id, due_date_str))
+        # the prolonged reservation moves to its new day, the finished one leaves its day
+        self.assertTrue(db_manager.update_reservation_due_date(username, book_ids[1], "15.03.2024"))
+        self.assertTrue(db_manager.finish_reservation(username, book_ids[2], "Overdue Book"))
+        self.assertFalse(db_manager.update_reservation_due_date(username, book_ids[2], "15.03.2024"))
+
+        buckets = list(db_manager.get_overdue_reservations(as_of=parse_due_date("16.03.2024"), max_in_flight=4))
+        self.assertEqual([[row.book_id for row in rows] for rows in buckets], [[book_ids[0]], [book_ids[1]]])
+        self.assertEqual(buckets[1][0].due_date, _to_timestamp(parse_due_date("15.03.2024")))
+        # as_of is exclusive
+        self.assertEqual(len(list(db_manager.get_overdue_reservations(as_of=parse_due_date("15.03.2024")))), 1)
+
+        # a reservation overdue for years is read as well, the sweeper drops the day left empty
+        self.assertTrue(db_manager.make_reservation(username, "Overdue Book", book_ids[2], "01.03.2019"))
+        buckets = list(db_manager.get_overdue_reservations(as_of=parse_due_date("16.03.2024")))
+        self.assertEqual([[row.book_id for row in rows] for rows in buckets], [[book_ids[2]], [book_ids[0]], [book_ids[1]]])
+        self.assertEqual(ReservationSweeper(db_manager).drop_empty_due_date_buckets(), 1)
+        days = [row.bucket for row in db_manager.execute('get_due_date_buckets', (due_date_bucket(parse_due_date("31.12.2024")),))]
+        self.assertEqual(days, [due_date_bucket(parse_due_date(day)) for day in ["01.03.2019", "01.03.2024", "15.03.2024", "20.03.2024"]])
+
+        # a day from today on is marked once by this process, a past day every time
+        marks = []
+        execute = db_manager.execute
+        def counting_execute(name, params):
+            if name == 'add_due_date_bucket':
+                marks.append(params[0])
+            return execute(name, params)
+        db_manager.execute = counting_execute
+        later_date_str = (datetime.now(timezone.utc) + timedelta(days=30)).strftime('%d.%m.%Y')
+        book_ids = db_manager.add_books_bulk([("Overdue Book", "Test Author")] * 3, progress_every=0)
+        for book_id, due_date_str in zip(book_ids, [later_date_str, later_date_str, "01.03.2024"]):
+            self.assertTrue(db_manager.make_reservation(username, "Overdue Book", book_id, due_date_str))
+        self.assertTrue(db_manager.update_reservation_due_date(username, book_ids[2], "02.03.2024"))
+        self.assertEqual(marks, [due_date_bucket(parse_due_date(day)) for day in [later_date_str, "01.03.2024", "02.03.2024"]])
+        self.assertIn(due_date_bucket(parse_due_date(later_date_str)), [row.bucket for row in execute('get_due_date_buckets', (due_date_bucket(parse_due_date(later_date_str)),))])
+
+    def test_book_cache(self):
+        db_manager = self.new_db_manager()
+        book_title = "Cached Book"
+        db_manager.add_book(book_title, "Test Author")
+        book = db_manager.get_books_by_title(book_title)[0]
+        cached_book = db_manager.get_books_by_title(book_title)[0]
+        self.assertEqual((cached_book.book_id, cached_book.available), (book.book_id, book.available))
+        self.assertIsNot(cached_book, book)
+        self.assertEqual(db_manager.title_cache.hits, 1)
+        self.assertEqual(db_manager.get_book_info(book_title, book.book_id), (book.book_id, book.title, book.author))
+        self.assertEqual(db_manager.book_cache.hits, 1)
+
+        # a lock on this node drops the cached availability
+        self.assertTrue(db_manager.lock_book(book.book_id, book_title))
+        self.assertFalse(db_manager.get_books_by_title(book_title)[0].available)
+
+        # a read that started before a lock on this node does not cache what it read
+        raced_title = "Raced Book"
+        db_manager.add_book(raced_title, "Test Author")
+        execute = db_manager.execute
+        def execute_then_lock(name, params):
+            rows = execute(name, params)
+            if name == 'get_books_by_title':
+                del db_manager.execute
+                self.assertTrue(db_manager.lock_book(rows.current_rows[0].book_id, raced_title))
+            return rows
+        db_manager.execute = execute_then_lock
+        self.assertTrue(db_manager.get_books_by_title(raced_title)[0].available)
+        self.assertFalse(db_manager.get_books_by_title(raced_title)[0].available)
+
+    # adds speciifed number of books and returns their titles
+    def add_some_books(self, num_books):
+        db_manager = self.new_db_manager()
+        book_titles = [f"Test Book {i+1}" for i in range(num_books)]
+        db_manager.add_books_bulk((book_title, "Test Author") for book_title in book_titles)
         return book_titles
+
+    def test_add_books_bulk(self, num_books=20000, num_titles=100):
+        db_manager = self.new_db_manager()
+        start_time = time.time()
+        book_ids = db_manager.add_books_bulk((f"Bulk Book {i % num_titles}", "Test Author") for i in range(num_books))
+        end_time = time.time()
+        print(f"Bulk insert Execution time: {end_time - start_time} seconds")
+        self.assertEqual(len(set(book_ids)), num_books)
+        books = db_manager.get_books_by_title("Bulk Book 0")
+        self.assertTrue(set(book.book_id for book in books) <= set(book_ids))
     
     def make_random_requests(self, books, username):
-            db_manager = DatabaseManagerSingleton(['127.0.1.1', '127.0.1.2', '127.0.1.3'])
+            db_manager = self.new_db_manager()
             db_manager.add_user(username)
             due_date_str = "01.01.2023"
             for _ in range(2000):
                 book_title = random.choice(books)
-                books_by_title = db_manager.get_books_by_title(book_title)
-                book_id = books_by_title[0].book_id
+                book_id = db_manager.find_available_book(book_title)
+                if book_id is None:
+                    continue
                 db_manager.make_reservation(username, book_title, book_id, due_date_str)
     
     def test_stress_2(self):
@@ -91,7 +739,7 @@ class ExampleTest(unittest.TestCase):
         self.assertTrue(self.check_reserved_books(usernames))
 
     def test_stress_3(self):
-        db_manager = DatabaseManagerSingleton(['127.0.1.1'])
+        db_manager = self.new_db_manager(['127.0.1.1'])
         db_manager.reset_tables()
         books = self.add_some_books(10)
         book_ids = [db_manager.get_books_by_title(title)[0].book_id for title in books]
@@ -129,13 +777,14 @@ class ExampleTest(unittest.TestCase):
         self.assertGreater(len(Marek_books), 0)
 
     def claim_books_pool(self, book_titles, books_ids, username, contact_points, barrier, due_date_str="11.11.2024"):
-        db_manager = DatabaseManagerSingleton(contact_points)
+        # every client talks only to its own node
+        db_manager = self.new_db_manager(contact_points, cluster_config=ClusterConfig(pin_to_contact_points=True))
         barrier.wait()
         for i in range(len(book_titles)):
             db_manager.make_reservation(username, book_titles[i], books_ids[i], due_date_str)
 
     def check_reserved_books(self, usernames):
-        db_manager = DatabaseManagerSingleton(['127.0.1.1', '127.0.1.2', '127.0.1.3'])
+        db_manager = self.new_db_manager()
         reserved_books = []
         book_ids = set()
 
@@ -151,34 +800,426 @@ class ExampleTest(unittest.TestCase):
 
         book_ids = set()
         for book in reserved_books:
-            if book[0].book_id in book_ids:
+            if book.book_id in book_ids:
                 return False
-            #print(book[0].book_id)
-            book_ids.add(book[0].book_id)
+            #print(book.book_id)
+            book_ids.add(book.book_id)
         
         print('STRESS TEST 2 CORRECT')
         return True
     
     def a_test_100_user_inserts(self):
-        db_manager = DatabaseManagerSingleton()
+        db_manager = self.new_db_manager()
         for i in range(100):
             db_manager.add_user(f'user{i}')
             self.assertEqual(db_manager.check_username_exists(f'user{i}'), True)
 
-class DatabaseManagerSingleton():  
-    def __init__(self, contact_points, logs_enabled=False, max_reserved_books=20):
-        self.cluster = Cluster(contact_points, port=9042)
-        self.logs_enabled = logs_enabled
-        self.max_reserved_books = max_reserved_books
-        self.log('initialization')
+# consistency level and serial consistency level of each named profile,
+# the -local variants keep the quorum and the Paxos rounds of conditional updates inside the local datacenter
+CONSISTENCY_PROFILES = {
+    'fast-read': (ConsistencyLevel.ONE, None),
+    'strong-read': (ConsistencyLevel.TWO, None),
+    'fast-write': (ConsistencyLevel.ONE, None),
+    'strong-write': (ConsistencyLevel.TWO, None),
+    'lwt': (ConsistencyLevel.TWO, ConsistencyLevel.SERIAL),
+    'lwt-local': (ConsistencyLevel.LOCAL_QUORUM, ConsistencyLevel.LOCAL_SERIAL),
+    'serial-read': (ConsistencyLevel.SERIAL, None),
+    'serial-read-local': (ConsistencyLevel.LOCAL_SERIAL, None),
+}
+
+# a profile name, a (consistency level, serial consistency level) pair, or level names such as "LOCAL_QUORUM/LOCAL_SERIAL"
+def parse_consistency_profile(value):
+    if isinstance(value, tuple):
+        return value
+    if value in CONSISTENCY_PROFILES:
+        return CONSISTENCY_PROFILES[value]
+    names = value.upper().split('/')
+    if len(names) > 2 or any(name not in ConsistencyLevel.name_to_value for name in names):
+        raise Exception(f"Unknown consistency profile: {value}")
+    levels = [ConsistencyLevel.name_to_value[name] for name in names]
+    return levels[0], levels[1] if len(levels) > 1 else None
+
+# every query used by the manager, with the name of the consistency profile it is executed with
+QUERIES = {
+    'add_book_with_id': ("INSERT INTO books (book_id, title, author, available) VALUES (?, ?, ?, true)", 'strong-write'),
+    'get_books_by_title': ("SELECT book_id, title, author, available FROM books WHERE title = ?", 'fast-read'),
+    'get_all_titles': ("SELECT DISTINCT title FROM books", 'fast-read'),
+    'add_title_prefix': ("INSERT INTO title_prefixes (prefix, title) VALUES (?, ?)", 'strong-write'),
+    'get_titles_by_prefix': ("SELECT title FROM title_prefixes WHERE prefix = ?", 'fast-read'),
+    # the availability index is a hint, a stale entry only costs a conditional update that is not applied
+    'add_available_book': ("INSERT INTO available_books (title, shard, book_id) VALUES (?, ?, ?)", 'fast-write'),
+    'remove_available_book': ("DELETE FROM available_books WHERE title = ? AND shard = ? AND book_id = ?", 'fast-write'),
+    'get_available_books': ("SELECT book_id FROM available_books WHERE title = ? AND shard = ? LIMIT ?", 'fast-read'),
+    'get_book': ("SELECT book_id, title, author, available FROM books WHERE title = ? AND book_id = ?", 'strong-read'),
+    'lock_book': ("UPDATE books SET available = false, reserved_by = ?, reservation_id = ? WHERE book_id = ? AND title = ? IF available = true", 'lwt'),
+    'unlock_book': ("UPDATE books SET available = true, reserved_by = null, reservation_id = null WHERE book_id = ? AND title = ?", 'strong-write'),
+    # unlocks the book only while it is still held by the given reservation
+    'release_book': ("UPDATE books SET available = true, reserved_by = null, reservation_id = null WHERE book_id = ? AND title = ? IF reservation_id = ?", 'lwt'),
+    # linearizable read of the lock, tells whether a conditional update that timed out was applied
+    'get_book_lock': ("SELECT available, reservation_id FROM books WHERE title = ? AND book_id = ?", 'serial-read'),
+    # users whose reserved_books update had an unknown outcome, kept until the ReservationSweeper recounts them
+    'add_user_to_reconcile': ("INSERT INTO users_to_reconcile (username) VALUES (?)", 'strong-write'),
+    'delete_user_to_reconcile': ("DELETE FROM users_to_reconcile WHERE username = ?", 'strong-write'),
+    'get_users_to_reconcile': ("SELECT username FROM users_to_reconcile", 'strong-read'),
+    # every lock attempt, written alongside the lock and left to expire, the ReservationSweeper reads these instead of every book
+    'add_pending_lock': ("INSERT INTO pending_locks (bucket, shard, book_id, reservation_id, title, reserved_by, locked_at) VALUES (?, ?, ?, ?, ?, ?, ?) USING TTL ?", 'strong-write'),
+    'get_pending_locks': ("SELECT book_id, reservation_id, title, reserved_by, locked_at FROM pending_locks WHERE bucket = ? AND shard = ?", 'strong-read'),
+    'get_all_availability': ("SELECT title, book_id, available FROM books", 'fast-read'),
+    'add_user': ("INSERT INTO users (username, reserved_books) VALUES (?, 0) IF NOT EXISTS", 'lwt'),
+    'get_user': ("SELECT username, reserved_books FROM users WHERE username = ?", 'strong-read'),
+    'check_username_exists': ("SELECT * FROM users WHERE username = ?", 'strong-read'),
+    'check_user_reserved_books': ("SELECT reserved_books FROM users WHERE username = ?", 'strong-read'),
+    'increment_user_reserved_books': ("UPDATE users SET reserved_books = reserved_books + 1 WHERE username = ? IF reserved_books < ?", 'lwt'),
+    'set_user_reserved_books': ("UPDATE users SET reserved_books = ? WHERE username = ? IF reserved_books = ?", 'lwt'),
+    # every write of a reservation row is conditional, a plain write mixed with the conditional delete could be shadowed by its tombstone
+    'add_reservation': ("INSERT INTO reservations (username, book_id, book_title, due_date, reservation_id) VALUES (?, ?, ?, ?, ?) IF NOT EXISTS", 'lwt'),
+    'get_user_reservations': ("SELECT book_title, book_id, due_date, reservation_id FROM reservations WHERE username = ?", 'fast-read'),
+    # linearizable with the conditional writes of the reservations, counted by reconcile_user_reserved_books
+    'get_user_reservation_ids': ("SELECT book_id, reservation_id FROM reservations WHERE username = ?", 'serial-read'),
+    'get_reservation': ("SELECT book_title, book_id, due_date, reservation_id FROM reservations WHERE username = ? AND book_id = ?", 'fast-read'),
+    # tell the ReservationSweeper whether a lock still holds its book and is backed by its reservation,
+    # read at the level the conditional updates commit at, as a stale read would release a reserved book
+    'get_book_holder': ("SELECT reservation_id FROM books WHERE title = ? AND book_id = ?", 'strong-read'),
+    'get_reservation_id': ("SELECT reservation_id FROM reservations WHERE username = ? AND book_id = ?", 'strong-read'),
+    'get_all_reservations': ("SELECT username, book_id, book_title, due_date, reservation_id FROM reservations", 'fast-read'),
+    # the due date condition tells which row of reservations_by_due_date goes with the deleted or updated reservation
+    'delete_reservation': ("DELETE FROM reservations WHERE username = ? AND book_id = ? IF book_title = ? AND due_date = ?", 'lwt'),
+    'update_reservation_due_date': ("UPDATE reservations SET due_date = ? WHERE username = ? AND book_id = ? IF due_date = ?", 'lwt'),
+    'add_reservation_by_due_date': ("INSERT INTO reservations_by_due_date (bucket, due_date, username, book_id, book_title, reservation_id) VALUES (?, ?, ?, ?, ?, ?)", 'strong-write'),
+    'delete_reservation_by_due_date': ("DELETE FROM reservations_by_due_date WHERE bucket = ? AND due_date = ? AND username = ? AND book_id = ?", 'strong-write'),
+    'get_reservations_due': ("SELECT due_date, username, book_id, book_title, reservation_id FROM reservations_by_due_date WHERE bucket = ? AND due_date < ?", 'fast-read'),
+    'get_first_reservation_due': ("SELECT due_date, username, book_id, book_title, reservation_id FROM reservations_by_due_date WHERE bucket = ? LIMIT 1", 'strong-read'),
+    # the days that have reservations due, so the overdue reservations are read from the oldest of them on
+    'add_due_date_bucket': ("INSERT INTO due_date_buckets (shard, bucket) VALUES (0, ?)", 'strong-write'),
+    'delete_due_date_bucket': ("DELETE FROM due_date_buckets WHERE shard = 0 AND bucket = ?", 'strong-write'),
+    'get_due_date_buckets': ("SELECT bucket FROM due_date_buckets WHERE shard = 0 AND bucket <= ?", 'strong-read'),
+}
+
+# conditional updates, their result rows carry the applied flag
+LWT_QUERIES = [name for name, (query, profile) in QUERIES.items() if ' IF ' in query]
+
+# reads can be sent to a second replica while the first is slow
+IDEMPOTENT_QUERIES = [name for name, (query, profile) in QUERIES.items() if query.startswith('SELECT')]
+
+# columns added after the first release, created on clusters whose tables predate them
+ADDED_COLUMNS = [('books', 'reserved_by', 'text'), ('books', 'reservation_id', 'uuid'), ('reservations', 'reservation_id', 'uuid')]
+
+# errors after which the request is known not to have been applied, and errors after which its outcome is unknown
+NOT_APPLIED_ERRORS = (NoHostAvailable, Unavailable)
+UNCERTAIN_ERRORS = (WriteTimeout, ReadTimeout, OperationTimedOut)
+
+# attempts with exponential backoff and full jitter
+class RetryPolicy():
+    def __init__(self, max_attempts=5, base_delay=0.01, max_delay=0.5):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+    def backoff(self, attempt):
+        time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+
+# titles are indexed under each lowercase prefix up to this length, longer search terms filter the longest prefix
+TITLE_PREFIX_LENGTH = 8
+
+def title_prefixes(title):
+    title = title.lower()
+    return [title[:i] for i in range(1, min(len(title), TITLE_PREFIX_LENGTH) + 1)]
+
+# the available copies of a title are spread over this many partitions of the availability index,
+# so the index updates of a popular title do not all land on one partition
+AVAILABILITY_SHARDS = 4
+
+def availability_shard(book_id):
+    return book_id.int % AVAILABILITY_SHARDS
+
+# pending_locks keeps the locks taken in one window of PENDING_LOCK_BUCKET_SECONDS in PENDING_LOCK_SHARDS partitions,
+# so no partition takes every lock of the cluster and the ReservationSweeper reads a window once it is old enough,
+# the rows expire after PENDING_LOCK_TTL seconds instead of being deleted, locked_at is in microseconds
+PENDING_LOCK_BUCKET_SECONDS = 600
+PENDING_LOCK_SHARDS = 16
+PENDING_LOCK_TTL = 6 * 3600
+
+def pending_lock_bucket(locked_at):
+    return int(locked_at // (PENDING_LOCK_BUCKET_SECONDS * 1000000))
+
+def pending_lock_row(book_id, title, username, reservation_id):
+    locked_at = int(time.time() * 1000000)
+    return (pending_lock_bucket(locked_at), book_id.int % PENDING_LOCK_SHARDS, book_id, reservation_id, title, username, locked_at, PENDING_LOCK_TTL)
+
+# reservations_by_due_date keeps the reservations due on one day in one partition, the bucket is the day since the epoch
+def due_date_bucket(due_date):
+    return (_to_timestamp(due_date) - datetime(1970, 1, 1)).days
+
+def parse_due_date(due_date_str):
+    due_date = datetime.strptime(due_date_str, '%d.%m.%Y')
+    return due_date.replace(tzinfo=timezone.utc)
+
+# streams (title, author) pairs from a csv file with title and author columns
+def read_books_csv(path):
+    with open(path, newline='', encoding='utf-8') as file:
+        for row in csv.DictReader(file):
+            yield row['title'], row['author']
+
+# streams (title, author) pairs from a file with one json object per line
+def read_books_jsonl(path):
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                book = json.loads(line)
+                yield book['title'], book['author']
+
+# title and author never change after add_book, so these are safe to keep for as long as they are used
+BookInfo = namedtuple('BookInfo', ['book_id', 'title', 'author'])
+
+# books and reservations read by the manager, slots instead of a dict per row keep large result sets small
+class Book():
+    __slots__ = ('book_id', 'title', 'author', 'available')
+    def __init__(self, book_id, title, author, available):
+        self.book_id = book_id
+        self.title = title
+        self.author = author
+        self.available = available
+    def __repr__(self):
+        return f"Book({self.book_id}, {self.title!r}, {self.author!r}, {self.available})"
+
+# book is the BookInfo of the reserved book, filled in by get_user_reserved_books
+class Reservation():
+    __slots__ = ('book_title', 'book_id', 'due_date', 'reservation_id', 'book')
+    def __init__(self, book_title, book_id, due_date, reservation_id, book=None):
+        self.book_title = book_title
+        self.book_id = book_id
+        self.due_date = due_date
+        self.reservation_id = reservation_id
+        self.book = book
+    def __repr__(self):
+        return f"Reservation({self.book_title!r}, {self.book_id}, {self.due_date}, {self.reservation_id})"
+
+# selected columns -> value type the rows are returned as
+BOOK_COLUMNS = ('book_id', 'title', 'author', 'available')
+RESERVATION_COLUMNS = ('book_title', 'book_id', 'due_date', 'reservation_id')
+ROW_TYPES = {BOOK_COLUMNS: Book, RESERVATION_COLUMNS: Reservation}
+
+# the rows of one page, a value object is built only for the rows that are indexed or iterated over
+class LazyRows():
+    __slots__ = ('row_type', 'rows')
+    def __init__(self, row_type, rows):
+        self.row_type = row_type
+        self.rows = rows
+    def __len__(self):
+        return len(self.rows)
+    def __bool__(self):
+        return bool(self.rows)
+    def __iter__(self):
+        row_type = self.row_type
+        for row in self.rows:
+            yield row_type(*row)
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return LazyRows(self.row_type, self.rows[index])
+        return self.row_type(*self.rows[index])
+
+# row factory of every execution profile, rows of other columns stay named tuples
+def library_row_factory(colnames, rows):
+    row_type = ROW_TYPES.get(tuple(colnames))
+    if row_type is None:
+        return named_tuple_factory(colnames, rows)
+    return LazyRows(row_type, rows)
+
+# bounded LRU cache, entries older than ttl seconds are dropped on read (ttl=None keeps them until evicted)
+class LRUCache():
+    def __init__(self, max_size, ttl=None, num_generations=1024):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        # striped like the locks of the BookGate, a key shares its generation with others, which only drops more puts
+        self.generations = [0] * num_generations
+        self.hits = 0
+        self.misses = 0
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and (self.ttl is None or entry[0] > time.monotonic()):
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+    # read before the value is read from the database, a put with an older generation is dropped,
+    # as the key was invalidated while the value was being read
+    def generation(self, key):
+        with self.lock:
+            return self.generations[hash(key) % len(self.generations)]
+    def put(self, key, value, generation=None):
+        with self.lock:
+            if generation is not None and generation != self.generations[hash(key) % len(self.generations)]:
+                return
+            expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+            self.entries[key] = (expires_at, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+    def invalidate(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.generations[hash(key) % len(self.generations)] += 1
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generations = [generation + 1 for generation in self.generations]
+
+# in-process admission control for hot books: one local caller at a time runs the conditional update for a book,
+# and books seen unavailable in the last unavailable_ttl seconds fail without a Paxos round
+class BookGate():
+    def __init__(self, num_locks=1024, unavailable_ttl=0.5, max_size=100000):
+        # striped locks keep memory bounded no matter how many books are seen
+        self.locks = [threading.Lock() for _ in range(num_locks)]
+        self.unavailable = LRUCache(max_size, unavailable_ttl)
+    def lock_for(self, book_id):
+        return self.locks[hash(book_id) % len(self.locks)]
+    def is_unavailable(self, book_id):
+        return self.unavailable.get(book_id) is not None
+    def mark_unavailable(self, book_id):
+        self.unavailable.put(book_id, True)
+    def mark_available(self, book_id):
+        self.unavailable.invalidate(book_id)
+
+# prepares each query once per session and hands out the prepared statement on every call
+class StatementRegistry():
+    def __init__(self, session, queries):
+        self.session = session
+        self.queries = queries
+        self.prepared = {}
+        self.lock = threading.Lock()
+    def get(self, name):
+        statement = self.prepared.get(name)
+        if statement is None:
+            with self.lock:
+                statement = self.prepared.get(name)
+                if statement is None:
+                    query, profile = self.queries[name]
+                    statement = self.session.prepare(query)
+                    statement.is_idempotent = name in IDEMPOTENT_QUERIES
+                    self.prepared[name] = statement
+        return statement
+    # the execution profile the statement runs with, it carries the consistency levels
+    def profile(self, name):
+        return self.queries[name][1]
+    def prepare_all(self):
+        for name in self.queries:
+            self.get(name)
+
+def _to_timestamp(value):
+    # cassandra stores timestamps in UTC and reads them back without tzinfo
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+# counts the hosts the wrapped policy hands out, every host of a query plan that is used is one request sent to it,
+# including retries on the next host and speculative executions
+class HostRequestCounter(WrapperPolicy):
+    def __init__(self, child_policy):
+        super().__init__(child_policy)
+        self.lock = threading.Lock()
+        self.requests = collections.Counter()
+    def make_query_plan(self, working_keyspace=None, query=None):
+        for host in self._child_policy.make_query_plan(working_keyspace, query):
+            with self.lock:
+                self.requests[host.address] += 1
+            yield host
+    def counts(self):
+        with self.lock:
+            return dict(self.requests)
+
+# how the driver routes requests:
+# local_dc is the datacenter whose nodes are used, None takes the datacenter of the first contact point,
+# pin_to_contact_points=True sends requests only to the contact points instead of every node the driver discovers,
+# token_aware=True sends bound statements to a replica of their partition,
+# speculative_delay sends a read that has not completed after this many seconds to the next replica as well, up to speculative_attempts times,
+# connections_per_host only applies to protocol versions 1 and 2, from 3 on the driver multiplexes every request over one connection per host,
+# consistency_profiles overrides the levels of the profiles in CONSISTENCY_PROFILES, {'lwt': 'lwt-local'} runs every conditional update
+# with the levels of lwt-local, see parse_consistency_profile for the accepted values
+class ClusterConfig():
+    def __init__(self, local_dc=None, pin_to_contact_points=False, token_aware=True, speculative_delay=None, speculative_attempts=2,
+                 connections_per_host=None, protocol_version=None, request_timeout=10.0, consistency_profiles=None):
+        self.local_dc = local_dc
+        self.pin_to_contact_points = pin_to_contact_points
+        self.token_aware = token_aware
+        self.speculative_delay = speculative_delay
+        self.speculative_attempts = speculative_attempts
+        self.connections_per_host = connections_per_host
+        self.protocol_version = protocol_version
+        self.request_timeout = request_timeout
+        self.consistency_profiles = {name: parse_consistency_profile(value) for name, value in (consistency_profiles or {}).items()}
+        for name in self.consistency_profiles:
+            if name not in CONSISTENCY_PROFILES:
+                raise Exception(f"Unknown consistency profile: {name}")
+    # backends are shared per contact points, keyspace and configuration
+    def key(self):
+        return tuple(sorted((name, tuple(sorted(value.items())) if isinstance(value, dict) else value) for name, value in vars(self).items()))
+    # (consistency level, serial consistency level) of every profile
+    def consistency_levels(self):
+        return {**CONSISTENCY_PROFILES, **self.consistency_profiles}
+    def load_balancing_policy(self, contact_points):
+        if self.pin_to_contact_points:
+            policy = WhiteListRoundRobinPolicy(contact_points)
+        else:
+            policy = DCAwareRoundRobinPolicy(local_dc=self.local_dc)
+        if self.token_aware:
+            policy = TokenAwarePolicy(policy)
+        return HostRequestCounter(policy)
+    def speculative_execution_policy(self):
+        if self.speculative_delay is None:
+            return None
+        return ConstantSpeculativeExecutionPolicy(self.speculative_delay, self.speculative_attempts)
+
+# storage backends run the named QUERIES, execute returns a result with one() and current_rows,
+# execute_async and execute_batch_async return a future with result() and add_callbacks(callback, errback)
+class CassandraBackend():
+    # (contact points, keyspace, config) -> backend, shared by every manager in the process
+    _shared = {}
+    _shared_lock = threading.Lock()
+    def __init__(self, contact_points, keyspace='library_project', log=print, config=None):
+        self.log = log
+        self.config = config if config is not None else ClusterConfig()
+        self.host_requests = self.config.load_balancing_policy(contact_points)
+        # one execution profile per consistency profile, all routed alike
+        def new_profile(consistency_level=ConsistencyLevel.LOCAL_ONE, serial_consistency_level=None):
+            return ExecutionProfile(load_balancing_policy=self.host_requests, request_timeout=self.config.request_timeout,
+                                    speculative_execution_policy=self.config.speculative_execution_policy(),
+                                    consistency_level=consistency_level, serial_consistency_level=serial_consistency_level,
+                                    row_factory=library_row_factory)
+        profiles = {name: new_profile(*levels) for name, levels in self.config.consistency_levels().items()}
+        profiles[EXEC_PROFILE_DEFAULT] = new_profile()
+        cluster_options = {'protocol_version': self.config.protocol_version} if self.config.protocol_version is not None else {}
+        self.cluster = Cluster(contact_points, port=9042, execution_profiles=profiles, **cluster_options)
         self.session = self.cluster.connect()
         self.log('connected to cluster')
-        self.session.set_keyspace('library_project')
+        self.set_connections_per_host()
+        self.session.set_keyspace(keyspace)
         self.log('keyspace set')
         self.create_tables_if_not_exist()        
-    def log(self, message):
-        if self.logs_enabled:
-            print(message)
+        self.statements = StatementRegistry(self.session, QUERIES)
+        self.statements.prepare_all()
+        self.log('statements prepared')
+    def execute(self, name, params):
+        return self.session.execute(self.statements.get(name), params, execution_profile=self.statements.profile(name))
+    def execute_async(self, name, params):
+        return self.session.execute_async(self.statements.get(name), params, execution_profile=self.statements.profile(name))
+    # one page of rows and the paging state of the next page, None after the last page
+    def execute_page(self, name, params, page_size, paging_state=None):
+        statement = self.statements.get(name).bind(params)
+        statement.fetch_size = page_size
+        result = self.session.execute(statement, paging_state=paging_state, execution_profile=self.statements.profile(name))
+        return result.current_rows, result.paging_state
+    # unlogged batch of one statement, only worth it when all rows share a partition key
+    def execute_batch_async(self, name, rows):
+        statement = self.statements.get(name)
+        batch = BatchStatement(batch_type=BatchType.UNLOGGED)
+        for params in rows:
+            batch.add(statement, params)
+        return self.session.execute_async(batch, execution_profile=self.statements.profile(name))
     def create_tables_if_not_exist(self):
         self.session.execute(
             """
@@ -187,6 +1228,8 @@ class DatabaseManagerSingleton():
                 title text,
                 author text,
                 available boolean,
+                reserved_by text,
+                reservation_id uuid,
                 PRIMARY KEY (title, book_id)
             )
             """
@@ -209,196 +1252,1609 @@ class DatabaseManagerSingleton():
             book_id uuid,
             book_title text,
             due_date timestamp,
+            reservation_id uuid,
             PRIMARY KEY (username, book_id)
             )
             """
         )
         self.log('created reservations')
+        # day bucket -> reservations due that day, ordered by due date
+        self.session.execute(
+            """
+            CREATE TABLE IF NOT EXISTS reservations_by_due_date (
+            bucket int,
+            due_date timestamp,
+            username text,
+            book_id uuid,
+            book_title text,
+            reservation_id uuid,
+            PRIMARY KEY (bucket, due_date, username, book_id)
+            )
+            """
+        )
+        self.log('created reservations_by_due_date')
+        # a single partition with a row per day that has reservations due, the ReservationSweeper drops the emptied days
+        self.session.execute(
+            """
+            CREATE TABLE IF NOT EXISTS due_date_buckets (
+            shard int,
+            bucket int,
+            PRIMARY KEY (shard, bucket)
+            )
+            """
+        )
+        self.log('created due_date_buckets')
+        # every lowercase title prefix up to TITLE_PREFIX_LENGTH -> titles starting with it
+        self.session.execute(
+            """
+            CREATE TABLE IF NOT EXISTS title_prefixes (
+            prefix text,
+            title text,
+            PRIMARY KEY (prefix, title)
+            )
+            """
+        )
+        self.log('created title_prefixes')
+        # (title, shard) -> ids of the copies that are not reserved
+        self.session.execute(
+            """
+            CREATE TABLE IF NOT EXISTS available_books (
+            title text,
+            shard int,
+            book_id uuid,
+            PRIMARY KEY ((title, shard), book_id)
+            )
+            """
+        )
+        self.log('created available_books')
+        # (time window, shard) -> lock attempts of that window, one row per attempt, as several may try the same book,
+        # the rows expire, so a window is dropped whole by the time window compaction
+        self.session.execute(
+            """
+            CREATE TABLE IF NOT EXISTS pending_locks (
+            bucket int,
+            shard int,
+            book_id uuid,
+            reservation_id uuid,
+            title text,
+            reserved_by text,
+            locked_at bigint,
+            PRIMARY KEY ((bucket, shard), book_id, reservation_id)
+            ) WITH compaction = {'class': 'TimeWindowCompactionStrategy', 'compaction_window_unit': 'HOURS', 'compaction_window_size': 1}
+            """
+        )
+        self.log('created pending_locks')
+        # small, a row lives only from an uncertain counter update to the next sweep
+        self.session.execute(
+            """
+            CREATE TABLE IF NOT EXISTS users_to_reconcile (
+            username text,
+            PRIMARY KEY (username)
+            )
+            """
+        )
+        self.log('created users_to_reconcile')
+        self.add_missing_columns()
+    def add_missing_columns(self):
+        self.cluster.refresh_schema_metadata()
+        tables = self.cluster.metadata.keyspaces[self.session.keyspace].tables
+        for table, column, column_type in ADDED_COLUMNS:
+            if column not in tables[table].columns:
+                self.session.execute(f"ALTER TABLE {table} ADD {column} {column_type}")
+                self.log(f'added {table}.{column}')
     def reset_tables(self):
         self.session.execute("DROP TABLE IF EXISTS books")
         self.session.execute("DROP TABLE IF EXISTS users")
         self.session.execute("DROP TABLE IF EXISTS reservations")
+        self.session.execute("DROP TABLE IF EXISTS title_prefixes")
+        self.session.execute("DROP TABLE IF EXISTS available_books")
+        self.session.execute("DROP TABLE IF EXISTS reservations_by_due_date")
+        self.session.execute("DROP TABLE IF EXISTS due_date_buckets")
+        self.session.execute("DROP TABLE IF EXISTS pending_locks")
+        self.session.execute("DROP TABLE IF EXISTS users_to_reconcile")
         self.create_tables_if_not_exist()  
+        # statements prepared against the dropped tables are invalidated by the server
+        self.statements = StatementRegistry(self.session, QUERIES)
+        self.statements.prepare_all()
+    def set_connections_per_host(self):
+        connections = self.config.connections_per_host
+        if connections is None:
+            return
+        if self.cluster.protocol_version >= 3:
+            self.log(f"protocol version {self.cluster.protocol_version} uses one connection per host, connections_per_host is ignored")
+            return
+        # the core count may not exceed the max count at any point
+        if connections > self.cluster.get_max_connections_per_host(HostDistance.LOCAL):
+            self.cluster.set_max_connections_per_host(HostDistance.LOCAL, connections)
+            self.cluster.set_core_connections_per_host(HostDistance.LOCAL, connections)
+        else:
+            self.cluster.set_core_connections_per_host(HostDistance.LOCAL, connections)
+            self.cluster.set_max_connections_per_host(HostDistance.LOCAL, connections)
+    # requests sent to each host since the backend connected
+    def host_request_counts(self):
+        return self.host_requests.counts()
+    def shutdown(self):
+        self.cluster.shutdown()
+    # one pooled session per contact points, keyspace and configuration, the schema is created when it is first connected
+    @classmethod
+    def shared(cls, contact_points, keyspace='library_project', log=print, config=None):
+        config = config if config is not None else ClusterConfig()
+        key = (tuple(sorted(contact_points or ())), keyspace, config.key())
+        with cls._shared_lock:
+            backend = cls._shared.get(key)
+            if backend is None:
+                backend = cls(contact_points, keyspace, log, config)
+                cls._shared[key] = backend
+            return backend
+    @classmethod
+    def shutdown_shared(cls):
+        with cls._shared_lock:
+            for backend in cls._shared.values():
+                backend.shutdown()
+            cls._shared.clear()
+
+BookRow = namedtuple('BookRow', ['title', 'book_id', 'author', 'available', 'reservation_id', 'reserved_by'])
+AvailabilityRow = namedtuple('AvailabilityRow', ['title', 'book_id', 'available'])
+UserRow = namedtuple('UserRow', ['username', 'reserved_books'])
+ReservedBooksRow = namedtuple('ReservedBooksRow', ['reserved_books'])
+ReservationRow = namedtuple('ReservationRow', ['username', 'book_id', 'book_title', 'due_date', 'reservation_id'])
+LWTRow = namedtuple('LWTRow', ['applied'])
+# a conditional update on reserved_books that was not applied also returns the current value
+ReservedBooksLWTRow = namedtuple('ReservedBooksLWTRow', ['applied', 'reserved_books'])
+TitleRow = namedtuple('TitleRow', ['title'])
+AvailableBookRow = namedtuple('AvailableBookRow', ['book_id'])
+DueReservationRow = namedtuple('DueReservationRow', ['due_date', 'username', 'book_id', 'book_title', 'reservation_id'])
+# conditional updates on a reservation that were not applied return the values of the columns in their condition
+ReservationLWTRow = namedtuple('ReservationLWTRow', ['applied', 'book_title', 'due_date'])
+DueDateLWTRow = namedtuple('DueDateLWTRow', ['applied', 'due_date'])
+UserToReconcileRow = namedtuple('UserToReconcileRow', ['username'])
+DueDateBucketRow = namedtuple('DueDateBucketRow', ['bucket'])
+PendingLockRow = namedtuple('PendingLockRow', ['book_id', 'reservation_id', 'title', 'reserved_by', 'locked_at'])
+# a conditional insert that was not applied returns the row in the way
+ReservationExistsRow = namedtuple('ReservationExistsRow', ['applied', 'username', 'book_id', 'book_title', 'due_date', 'reservation_id'])
+
+class InMemoryResult():
+    def __init__(self, rows=()):
+        self.current_rows = rows if isinstance(rows, LazyRows) else list(rows)
+    def one(self):
+        return self.current_rows[0] if self.current_rows else None
+    def __iter__(self):
+        return iter(self.current_rows)
+    def __bool__(self):
+        return bool(self.current_rows)
+
+# already completed, callbacks run right away on the calling thread
+class InMemoryFuture():
+    def __init__(self, result=None, exception=None):
+        self._result = result
+        self._exception = exception
+    def result(self):
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+    def add_callbacks(self, callback, errback):
+        if self._exception is not None:
+            errback(self._exception)
+        else:
+            callback(self._result.current_rows)
+
+# thread-safe emulation of the books, users and reservations tables, every statement runs under one lock,
+# so the IF clauses behave like serial compare-and-set just as the Paxos rounds do on the cluster,
+# latency adds a simulated round trip to every blocking execute, outside the lock so that callers interleave
+class InMemoryBackend():
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.reset_tables()
+    def execute(self, name, params):
+        if self.latency:
+            time.sleep(self.latency)
+        with self.lock:
+            return InMemoryResult(getattr(self, '_' + name)(*params))
+    # the paging state is the offset of the next page
+    def execute_page(self, name, params, page_size, paging_state=None):
+        rows = self.execute(name, params).current_rows
+        offset = paging_state or 0
+        next_offset = offset + page_size
+        return rows[offset:next_offset], next_offset if next_offset < len(rows) else None
+    def execute_async(self, name, params):
+        try:
+            with self.lock:
+                return InMemoryFuture(InMemoryResult(getattr(self, '_' + name)(*params)))
+        except Exception as e:
+            return InMemoryFuture(exception=e)
+    # a conditional batch is applied as a whole or not at all and returns the rows whose condition failed,
+    # conditional batches only ever insert the reservations of one user
+    def execute_batch_async(self, name, rows):
+        try:
+            with self.lock:
+                if name in LWT_QUERIES:
+                    username = rows[0][0]
+                    saved = dict(self.reservations.get(username, {}))
+                    not_applied = [row for params in rows for row in getattr(self, '_' + name)(*params) if not row.applied]
+                    if not_applied:
+                        self.reservations[username] = saved
+                        return InMemoryFuture(InMemoryResult(not_applied))
+                    return InMemoryFuture(InMemoryResult([LWTRow(True)]))
+                for params in rows:
+                    getattr(self, '_' + name)(*params)
+        except Exception as e:
+            return InMemoryFuture(exception=e)
+        return InMemoryFuture(InMemoryResult())
+    def create_tables_if_not_exist(self):
+        pass
+    # there are no hosts behind the memory backend
+    def host_request_counts(self):
+        return {}
+    def reset_tables(self):
+        with self.lock:
+            # title -> book_id -> BookRow, username -> reserved_books, username -> book_id -> ReservationRow
+            self.books = collections.defaultdict(dict)
+            self.users = {}
+            self.reservations = collections.defaultdict(dict)
+            # prefix -> set of titles
+            self.title_prefixes = collections.defaultdict(set)
+            # (title, shard) -> set of book_ids
+            self.available_books = collections.defaultdict(set)
+            # bucket -> (due_date, username, book_id) -> DueReservationRow
+            self.reservations_by_due_date = collections.defaultdict(dict)
+            self.due_date_buckets = set()
+            # (bucket, shard) -> (book_id, reservation_id) -> (expires_at, PendingLockRow)
+            self.pending_locks = collections.defaultdict(dict)
+            self.users_to_reconcile = set()
+    def shutdown(self):
+        pass
+    def _add_book_with_id(self, book_id, title, author):
+        self.books[title][book_id] = BookRow(title, book_id, author, True, None, None)
+        return []
+    def _get_books_by_title(self, title):
+        return library_row_factory(BOOK_COLUMNS, [(book.book_id, book.title, book.author, book.available)
+                                                  for book in self.books.get(title, {}).values()])
+    def _get_all_titles(self):
+        return [TitleRow(title) for title in sorted(self.books) if self.books[title]]
+    def _add_title_prefix(self, prefix, title):
+        self.title_prefixes[prefix].add(title)
+        return []
+    def _get_titles_by_prefix(self, prefix):
+        return [TitleRow(title) for title in sorted(self.title_prefixes.get(prefix, ()))]
+    def _add_available_book(self, title, shard, book_id):
+        self.available_books[(title, shard)].add(book_id)
+        return []
+    def _remove_available_book(self, title, shard, book_id):
+        self.available_books[(title, shard)].discard(book_id)
+        return []
+    def _get_available_books(self, title, shard, limit):
+        return [AvailableBookRow(book_id) for book_id in sorted(self.available_books.get((title, shard), ()))[:limit]]
+    def _get_book(self, title, book_id):
+        book = self.books.get(title, {}).get(book_id)
+        return library_row_factory(BOOK_COLUMNS, [(book.book_id, book.title, book.author, book.available)] if book is not None else [])
+    def _lock_book(self, reserved_by, reservation_id, book_id, title):
+        book = self.books.get(title, {}).get(book_id)
+        if book is None or book.available is not True:
+            return [LWTRow(False)]
+        self.books[title][book_id] = book._replace(available=False, reserved_by=reserved_by, reservation_id=reservation_id)
+        return [LWTRow(True)]
+    # a plain UPDATE is an upsert
+    def _unlock_book(self, book_id, title):
+        book = self.books[title].get(book_id, BookRow(title, book_id, None, None, None, None))
+        self.books[title][book_id] = book._replace(available=True, reserved_by=None, reservation_id=None)
+        return []
+    def _release_book(self, book_id, title, reservation_id):
+        book = self.books.get(title, {}).get(book_id)
+        if book is None or book.reservation_id != reservation_id:
+            return [LWTRow(False)]
+        return [LWTRow(True)] + self._unlock_book(book_id, title)
+    def _get_book_lock(self, title, book_id):
+        book = self.books.get(title, {}).get(book_id)
+        return [book] if book is not None else []
+    def _get_book_holder(self, title, book_id):
+        return self._get_book_lock(title, book_id)
+    def _get_all_availability(self):
+        return [AvailabilityRow(book.title, book.book_id, book.available) for title in sorted(self.books) for book in self.books[title].values()]
+    def _add_user(self, username):
+        if username in self.users:
+            return [LWTRow(False)]
+        self.users[username] = 0
+        return [LWTRow(True)]
+    def _get_user(self, username):
+        return [UserRow(username, self.users[username])] if username in self.users else []
+    def _check_username_exists(self, username):
+        return self._get_user(username)
+    def _check_user_reserved_books(self, username):
+        return [ReservedBooksRow(self.users[username])] if username in self.users else []
+    def _increment_user_reserved_books(self, username, max_reserved_books):
+        if username not in self.users or not self.users[username] < max_reserved_books:
+            return [LWTRow(False)]
+        self.users[username] += 1
+        return [LWTRow(True)]
+    def _set_user_reserved_books(self, reserved_books, username, expected_reserved_books):
+        if username not in self.users:
+            return [LWTRow(False)]
+        if self.users[username] != expected_reserved_books:
+            return [ReservedBooksLWTRow(False, self.users[username])]
+        self.users[username] = reserved_books
+        return [LWTRow(True)]
+    def _add_reservation(self, username, book_id, book_title, due_date, reservation_id):
+        reservation = self.reservations.get(username, {}).get(book_id)
+        if reservation is not None:
+            return [ReservationExistsRow(False, *reservation)]
+        self.reservations[username][book_id] = ReservationRow(username, book_id, book_title, _to_timestamp(due_date), reservation_id)
+        return [LWTRow(True)]
+    def _get_user_reservations(self, username):
+        return library_row_factory(RESERVATION_COLUMNS, [(row.book_title, row.book_id, row.due_date, row.reservation_id)
+                                                         for row in self.reservations.get(username, {}).values()])
+    def _get_reservation(self, username, book_id):
+        row = self.reservations.get(username, {}).get(book_id)
+        return library_row_factory(RESERVATION_COLUMNS, [(row.book_title, row.book_id, row.due_date, row.reservation_id)] if row is not None else [])
+    def _get_user_reservation_ids(self, username):
+        return self._get_user_reservations(username)
+    def _get_reservation_id(self, username, book_id):
+        return self._get_reservation(username, book_id)
+    def _get_all_reservations(self):
+        return [row for username in sorted(self.reservations) for row in self.reservations[username].values()]
+    def _delete_reservation(self, username, book_id, book_title, due_date):
+        reservation = self.reservations.get(username, {}).get(book_id)
+        # like Cassandra, a conditional statement that finds no row returns [applied] alone
+        if reservation is None:
+            return [LWTRow(False)]
+        if reservation.book_title != book_title or reservation.due_date != _to_timestamp(due_date):
+            return [ReservationLWTRow(False, reservation.book_title, reservation.due_date)]
+        del self.reservations[username][book_id]
+        return [LWTRow(True)]
+    def _update_reservation_due_date(self, due_date, username, book_id, expected_due_date):
+        reservation = self.reservations.get(username, {}).get(book_id)
+        if reservation is None:
+            return [LWTRow(False)]
+        if reservation.due_date != _to_timestamp(expected_due_date):
+            return [DueDateLWTRow(False, reservation.due_date)]
+        self.reservations[username][book_id] = reservation._replace(due_date=_to_timestamp(due_date))
+        return [LWTRow(True)]
+    def _add_reservation_by_due_date(self, bucket, due_date, username, book_id, book_title, reservation_id):
+        due_date = _to_timestamp(due_date)
+        self.reservations_by_due_date[bucket][(due_date, username, book_id)] = DueReservationRow(due_date, username, book_id, book_title, reservation_id)
+        return []
+    def _delete_reservation_by_due_date(self, bucket, due_date, username, book_id):
+        self.reservations_by_due_date[bucket].pop((_to_timestamp(due_date), username, book_id), None)
+        return []
+    def _add_user_to_reconcile(self, username):
+        self.users_to_reconcile.add(username)
+        return []
+    def _delete_user_to_reconcile(self, username):
+        self.users_to_reconcile.discard(username)
+        return []
+    def _get_users_to_reconcile(self):
+        return [UserToReconcileRow(username) for username in sorted(self.users_to_reconcile)]
+    def _add_pending_lock(self, bucket, shard, book_id, reservation_id, title, reserved_by, locked_at, ttl):
+        self.pending_locks[(bucket, shard)][(book_id, reservation_id)] = (time.time() + ttl, PendingLockRow(book_id, reservation_id, title, reserved_by, locked_at))
+        return []
+    # expired rows are left in place, like tombstones, and skipped
+    def _get_pending_locks(self, bucket, shard):
+        now = time.time()
+        return [row for key, (expires_at, row) in sorted(self.pending_locks.get((bucket, shard), {}).items()) if expires_at > now]
+    def _get_reservations_due(self, bucket, before):
+        before = _to_timestamp(before)
+        return [row for key, row in sorted(self.reservations_by_due_date.get(bucket, {}).items()) if row.due_date < before]
+    def _get_first_reservation_due(self, bucket):
+        return [row for key, row in sorted(self.reservations_by_due_date.get(bucket, {}).items())][:1]
+    def _add_due_date_bucket(self, bucket):
+        self.due_date_buckets.add(bucket)
+        return []
+    def _delete_due_date_bucket(self, bucket):
+        self.due_date_buckets.discard(bucket)
+        return []
+    def _get_due_date_buckets(self, last_bucket):
+        return [DueDateBucketRow(bucket) for bucket in sorted(self.due_date_buckets) if bucket <= last_bucket]
+
+# upper bounds in seconds, the last bucket is +Inf
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class Histogram():
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        self.max = max(self.max, value)
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.sum += other.sum
+        self.count += other.count
+        self.max = max(self.max, other.max)
+    # estimated q-quantile, interpolated linearly inside its bucket like Prometheus' histogram_quantile,
+    # a quantile in the +Inf bucket is capped at the largest value seen
+    def quantile(self, q):
+        if not self.count:
+            return None
+        rank = q * self.count
+        lower = 0.0
+        for bound, cumulative, count in zip(self.buckets + (self.max,), self.cumulative_counts(), self.counts):
+            if cumulative >= rank:
+                return min(self.max, lower + (bound - lower) * (rank - (cumulative - count)) / count)
+            lower = bound
+        return self.max
+    def cumulative_counts(self):
+        return list(itertools.accumulate(self.counts))
+    # (le label, cumulative count) pairs in the Prometheus bucket format
+    def labeled_buckets(self):
+        return list(zip([repr(bound) for bound in self.buckets] + ['+Inf'], self.cumulative_counts()))
+    def snapshot(self):
+        return {'count': self.count, 'sum': self.sum, 'buckets': dict(self.labeled_buckets())}
+
+# manager methods timed when metrics are enabled
+INSTRUMENTED_METHODS = ['add_book', 'add_books_bulk', 'get_books_by_title', 'add_user', 'get_user', 'check_username_exists',
+                        'get_book', 'get_book_info', 'find_available_book', 'check_user_reserved_books', 'lock_book', 'unlock_book', 'make_reservation',
+                        'make_reservations', 'lock_books', 'get_user_reserved_books', 'finish_reservation', 'increment_user_reserved_books',
+                        'reserve_user_slots', 'decrement_user_reserved_books', 'reconcile_user_reserved_books', 'update_reservation_due_date']
+
+# latency histograms per manager method and per statement, conditional update outcomes and NoHostAvailable errors,
+# one instance can be shared by many managers
+class Metrics():
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.method_latency = collections.defaultdict(Histogram)
+        self.statement_latency = collections.defaultdict(Histogram)
+        # (statement, applied) -> count
+        self.lwt_results = collections.Counter()
+        # statement -> count
+        self.no_host_available = collections.Counter()
+    def observe_method(self, name, seconds):
+        with self.lock:
+            self.method_latency[name].observe(seconds)
+    def observe_statement(self, name, seconds, rows):
+        with self.lock:
+            self.statement_latency[name].observe(seconds)
+            if name in LWT_QUERIES and rows:
+                self.lwt_results[(name, bool(rows[0].applied))] += 1
+    def observe_error(self, name, exception):
+        if isinstance(exception, NoHostAvailable):
+            with self.lock:
+                self.no_host_available[name] += 1
+    def timed(self, name, method):
+        def timed_method(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                self.observe_method(name, time.perf_counter() - start_time)
+        return timed_method
+    def snapshot(self):
+        with self.lock:
+            return {
+                'methods': {name: h.snapshot() for name, h in self.method_latency.items()},
+                'statements': {name: h.snapshot() for name, h in self.statement_latency.items()},
+                'lwt': {f"{name}:{'applied' if applied else 'not_applied'}": count for (name, applied), count in self.lwt_results.items()},
+                'no_host_available': dict(self.no_host_available),
+            }
+    def prometheus_text(self):
+        lines = []
+        with self.lock:
+            for metric, label, histograms in [('library_method_duration_seconds', 'method', self.method_latency),
+                                              ('library_statement_duration_seconds', 'statement', self.statement_latency)]:
+                lines.append(f"# TYPE {metric} histogram")
+                for name, h in sorted(histograms.items()):
+                    for le, count in h.labeled_buckets():
+                        lines.append(f'{metric}_bucket{{{label}="{name}",le="{le}"}} {count}')
+                    lines.append(f'{metric}_sum{{{label}="{name}"}} {h.sum}')
+                    lines.append(f'{metric}_count{{{label}="{name}"}} {h.count}')
+            lines.append("# TYPE library_lwt_total counter")
+            for (name, applied), count in sorted(self.lwt_results.items()):
+                lines.append(f'library_lwt_total{{statement="{name}",applied="{str(applied).lower()}"}} {count}')
+            lines.append("# TYPE library_no_host_available_total counter")
+            for name, count in sorted(self.no_host_available.items()):
+                lines.append(f'library_no_host_available_total{{statement="{name}"}} {count}')
+        return '\n'.join(lines) + '\n'
+    # adds the histograms and counters of another instance, such as one sent back by a worker process
+    def merge(self, other):
+        with self.lock:
+            for histograms, other_histograms in [(self.method_latency, other.method_latency), (self.statement_latency, other.statement_latency)]:
+                for name, h in other_histograms.items():
+                    histograms[name].merge(h)
+            self.lwt_results.update(other.lwt_results)
+            self.no_host_available.update(other.no_host_available)
+    # the lock stays behind when an instance is pickled for another process
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+    # calls callback with a snapshot every interval seconds until the returned event is set
+    def start_reporter(self, interval, callback=print):
+        stopped = threading.Event()
+        def report():
+            while not stopped.wait(interval):
+                callback(self.snapshot())
+        threading.Thread(target=report, daemon=True).start()
+        return stopped
+
+class DatabaseManagerSingleton():  
+    # contention_gate=True puts a BookGate in front of lock_book
+    # backend defaults to the process-wide CassandraBackend of contact_points, InMemoryBackend() needs no cluster
+    # metrics=Metrics() records latencies and counters, with None nothing is timed
+    # cluster_config=ClusterConfig() sets the routing of the CassandraBackend, managers with equal configs share it
+    def __init__(self, contact_points=None, logs_enabled=False, max_reserved_books=20, book_cache_size=10000, book_cache_ttl=5, contention_gate=False, backend=None, metrics=None, retry_policy=None, cluster_config=None):
+        self.logs_enabled = logs_enabled
+        self.max_reserved_books = max_reserved_books
+        # (title, book_id) -> BookInfo, and title -> book rows including availability
+        self.book_cache = LRUCache(book_cache_size) if book_cache_size else None
+        self.title_cache = LRUCache(book_cache_size, book_cache_ttl) if book_cache_size else None
+        self.book_gate = BookGate() if contention_gate else None
+        self.retry_policy = retry_policy if retry_policy is not None else RetryPolicy()
+        # users whose reserved_books may have drifted, recounted by the ReservationSweeper,
+        # also kept in the users_to_reconcile table for the sweepers of other and restarted processes
+        self.users_to_reconcile = set()
+        # operation -> attempts repeated after an error or a lost race
+        self.retries = collections.Counter()
+        self.retries_lock = threading.Lock()
+        # days from today on this process already marked in due_date_buckets, the ReservationSweeper only drops past days
+        # so these marks stay in place and are not written again for every reservation due on them
+        self.marked_due_date_buckets = set()
+        self.marked_due_date_buckets_lock = threading.Lock()
+        self.log('initialization')
+        self.backend = backend if backend is not None else CassandraBackend.shared(contact_points, log=self.log, config=cluster_config)
+        self.metrics = metrics
+        # wrapping on the instance keeps the methods untouched when metrics are disabled
+        if metrics is not None:
+            for name in INSTRUMENTED_METHODS:
+                setattr(self, name, metrics.timed(name, getattr(self, name)))
+    def execute(self, name, params):
+        if self.metrics is None:
+            return self.backend.execute(name, params)
+        start_time = time.perf_counter()
+        try:
+            result = self.backend.execute(name, params)
+        except Exception as e:
+            self.metrics.observe_error(name, e)
+            raise
+        self.metrics.observe_statement(name, time.perf_counter() - start_time, result.current_rows)
+        return result
+    def execute_async(self, name, params):
+        if self.metrics is None:
+            return self.backend.execute_async(name, params)
+        return self.observe_future(name, time.perf_counter(), self.backend.execute_async(name, params))
+    def execute_page(self, name, params, page_size, paging_state=None):
+        if self.metrics is None:
+            return self.backend.execute_page(name, params, page_size, paging_state)
+        start_time = time.perf_counter()
+        try:
+            rows, paging_state = self.backend.execute_page(name, params, page_size, paging_state)
+        except Exception as e:
+            self.metrics.observe_error(name, e)
+            raise
+        self.metrics.observe_statement(name, time.perf_counter() - start_time, rows)
+        return rows, paging_state
+    def execute_batch_async(self, name, rows):
+        if self.metrics is None:
+            return self.backend.execute_batch_async(name, rows)
+        return self.observe_future('batch_' + name, time.perf_counter(), self.backend.execute_batch_async(name, rows))
+    def observe_future(self, name, start_time, future):
+        future.add_callbacks(lambda rows: self.metrics.observe_statement(name, time.perf_counter() - start_time, rows),
+                             lambda exception: self.metrics.observe_error(name, exception))
+        return future
+    def log(self, message):
+        if self.logs_enabled:
+            print(message)
+    # availability of the title's books changed on this node
+    def invalidate_title(self, title):
+        if self.title_cache is not None:
+            self.title_cache.invalidate(title)
+    def create_tables_if_not_exist(self):
+        self.backend.create_tables_if_not_exist()
+    # address -> requests sent to that node, shows whether the load is spread over the cluster
+    def host_request_counts(self):
+        return self.backend.host_request_counts()
+    def reset_tables(self):
+        self.backend.reset_tables()
+        for cache in (self.book_cache, self.title_cache, self.book_gate and self.book_gate.unavailable):
+            if cache is not None:
+                cache.clear()
     def add_book(self, title, author):
-        query = SimpleStatement("""
-            INSERT INTO books (book_id, title, author, available) 
-            VALUES (uuid(), %s, %s, true)
-        """, consistency_level=ConsistencyLevel.TWO)
-        self.session.execute(query, (title, author))
+        book_id = uuid.uuid4()
+        self.execute('add_book_with_id', (book_id, title, author))
+        self.invalidate_title(title)
+        self.index_title(title)
+        self.index_availability(title, book_id, True).result()
         return True
+    # keeps the availability index in step with the book, returns the future of the write
+    def index_availability(self, title, book_id, available):
+        name = 'add_available_book' if available else 'remove_available_book'
+        return self.execute_async(name, (title, availability_shard(book_id), book_id))
+    # the lock and unlock paths wait for their index write and send it again when it failed, so a lost write does not hide
+    # a free copy and the write of a later lock or unlock of the book is not overtaken by it, a write that still fails
+    # leaves the entry to rebuild_availability_index
+    def update_availability_index(self, title, book_id, available):
+        name = 'add_available_book' if available else 'remove_available_book'
+        try:
+            self.execute_with_retry(name, (title, availability_shard(book_id), book_id), retry_timeouts=True)
+        except NOT_APPLIED_ERRORS + UNCERTAIN_ERRORS as e:
+            print(f"Error occurred while indexing the book: {e}")
+    # backfills the availability index for books added before it existed, and drops its stale entries
+    def rebuild_availability_index(self, page_size=500):
+        paging_state = None
+        while True:
+            rows, paging_state = self.execute_page('get_all_availability', (), page_size, paging_state)
+            for future in [self.index_availability(row.title, row.book_id, row.available is True) for row in rows]:
+                future.result()
+            if paging_state is None:
+                break
+    # any free copy of the title, read from a random shard of the availability index and from the others at once
+    # only when it has no free copy, the copy is picked at random, so concurrent callers spread over the copies
+    # instead of racing for the same one, with lock=True the copy is locked as well, moving on to the next candidate
+    # when another caller was faster, returns the book_id or None, the lock is taken for the given username and
+    # reservation_id, so it can be handed to make_reservation and is seen by the ReservationSweeper
+    def find_available_book(self, title, lock=False, username=None, reservation_id=None, candidates=20):
+        if lock and (username is None or reservation_id is None):
+            raise Exception("Locking a copy needs the username and reservation_id it is locked for")
+        shards = random.sample(range(AVAILABILITY_SHARDS), AVAILABILITY_SHARDS)
+        for shard_group in (shards[:1], shards[1:]):
+            futures = [self.execute_async('get_available_books', (title, shard, candidates)) for shard in shard_group]
+            book_ids = [row.book_id for future in futures for row in future.result()]
+            random.shuffle(book_ids)
+            if not lock:
+                if book_ids:
+                    return book_ids[0]
+                continue
+            for book_id in book_ids:
+                if self.lock_book(book_id, title, username, reservation_id):
+                    return book_id
+        self.log("No copy of the title is available")
+        return None
+    # adds the title under each of its prefixes, writing a title again is harmless
+    def index_title(self, title):
+        for future in [self.execute_async('add_title_prefix', (prefix, title)) for prefix in title_prefixes(title)]:
+            future.result()
+    # backfills the prefix index for books added before it existed
+    def rebuild_title_index(self):
+        for row in self.execute('get_all_titles', ()):
+            self.index_title(row.title)
+    # books is any iterable of (title, author), e.g. read_books_csv(path), returns the generated book ids in input order
+    def add_books_bulk(self, books, max_in_flight=32, batch_size=50, chunk_size=1000, progress_every=10000):
+        in_flight = threading.Semaphore(max_in_flight)
+        errors = []
+        def on_success(rows):
+            in_flight.release()
+        def on_error(exception):
+            errors.append(exception)
+            in_flight.release()
+
+        book_ids = []
+        indexed_titles = set()
+        start_time = time.time()
+        next_report = progress_every
+        books = iter(books)
+        while not errors:
+            chunk = list(itertools.islice(books, chunk_size))
+            if not chunk:
+                break
+            # rows of one title land in the same partition, so they can share an unlogged batch
+            rows_by_title = collections.defaultdict(list)
+            for title, author in chunk:
+                book_id = uuid.uuid4()
+                book_ids.append(book_id)
+                rows_by_title[title].append((book_id, title, author))
+            for title, rows in rows_by_title.items():
+                self.invalidate_title(title)
+                if title not in indexed_titles:
+                    indexed_titles.add(title)
+                    for prefix in title_prefixes(title):
+                        in_flight.acquire()
+                        self.execute_async('add_title_prefix', (prefix, title)).add_callbacks(on_success, on_error)
+                for i in range(0, len(rows), batch_size):
+                    in_flight.acquire()
+                    self.execute_batch_async('add_book_with_id', rows[i:i + batch_size]).add_callbacks(on_success, on_error)
+                # the index rows of one shard share a partition as well
+                rows_by_shard = collections.defaultdict(list)
+                for book_id, title, author in rows:
+                    rows_by_shard[availability_shard(book_id)].append((title, availability_shard(book_id), book_id))
+                for shard_rows in rows_by_shard.values():
+                    for i in range(0, len(shard_rows), batch_size):
+                        in_flight.acquire()
+                        self.execute_batch_async('add_available_book', shard_rows[i:i + batch_size]).add_callbacks(on_success, on_error)
+            if progress_every and len(book_ids) >= next_report:
+                print(f"Books added: {len(book_ids)}, {len(book_ids) / (time.time() - start_time)} rows/s")
+                next_report += progress_every
+        # wait for the batches still in flight
+        for _ in range(max_in_flight):
+            in_flight.acquire()
+        if errors:
+            raise errors[0]
+        self.log(f"Added {len(book_ids)} books in {time.time() - start_time} seconds")
+        return book_ids
+    # every reader gets its own Books, a cached title is decoded once and copied for each reader
     def get_books_by_title(self, title):
-        query = SimpleStatement("SELECT * FROM books WHERE title = %s", consistency_level=ConsistencyLevel.ONE)
-        rows = self.session.execute(query, (title,))
-        return rows._current_rows   
+        generation = None
+        if self.title_cache is not None:
+            books = self.title_cache.get(title)
+            if books is not None:
+                return [Book(book.book_id, book.title, book.author, book.available) for book in books]
+            generation = self.title_cache.generation(title)
+        rows = self.execute('get_books_by_title', (title,))
+        # a single page is returned as it is and decoded as it is read, iterating the result fetches every page
+        if self.title_cache is None and not getattr(rows, 'has_more_pages', False):
+            return rows.current_rows
+        books = list(rows)
+        if self.title_cache is not None:
+            # not cached when a lock or return on this node invalidated the title while it was read
+            self.title_cache.put(title, [Book(book.book_id, book.title, book.author, book.available) for book in books], generation)
+            for book in books:
+                self.book_cache.put((book.title, book.book_id), BookInfo(book.book_id, book.title, book.author))
+        return books   
+    # titles starting with term, ignoring case, found with a single read of the prefix index
+    def find_titles(self, term):
+        term = term.lower()
+        if not term:
+            return []
+        rows = self.execute('get_titles_by_prefix', (term[:TITLE_PREFIX_LENGTH],))
+        return [row.title for row in rows if row.title.lower().startswith(term)]
+    # yields (books, cursor) pages of the books whose title starts with term, ignoring case,
+    # search_books(term, cursor=cursor) resumes after the page the cursor was yielded with, the last page yields None
+    def search_books(self, term, page_size=50, cursor=None):
+        titles = self.find_titles(term)
+        for i, title in enumerate(titles):
+            # a cursor is (title, paging state of its next page), with no paging state the title is finished
+            if cursor is not None and (title < cursor[0] or (title == cursor[0] and cursor[1] is None)):
+                continue
+            paging_state = cursor[1] if cursor is not None and title == cursor[0] else None
+            while True:
+                books, paging_state = self.execute_page('get_books_by_title', (title,), page_size, paging_state)
+                last_page = paging_state is None and i == len(titles) - 1
+                if books:
+                    yield books, None if last_page else (title, paging_state)
+                if paging_state is None:
+                    break
     def add_user(self, username):
-        query = SimpleStatement("""
-            INSERT INTO users (username, reserved_books)
-            VALUES (%s, 0)
-            IF NOT EXISTS
-        """)
-        result = self.session.execute(query, (username,))
+        result = self.execute('add_user', (username,))
         if result.one().applied:
             self.log("User added successfully!")
             return True
         else:
             self.log("Username already exists. Please choose a different username.")
             return False   
+    def get_user(self, username):
+        rows = self.execute('get_user', (username,))
+        return rows.one()
     def check_username_exists(self, username):
-        query = SimpleStatement("SELECT * FROM users WHERE username = %s", consistency_level=ConsistencyLevel.TWO)
         self.log('checking username exists')
-        rows = self.session.execute(query, (username,))
-        if len(rows._current_rows) > 0:
+        rows = self.execute('check_username_exists', (username,))
+        if len(rows.current_rows) > 0:
             self.log('user exists')
             return True
         self.log('user does not exist')
         return False
     def get_book(self, title, book_id):
-            query = SimpleStatement("SELECT * FROM books WHERE title = %s AND book_id = %s", consistency_level=ConsistencyLevel.TWO)
-            rows = self.session.execute(query, (title, book_id))
+            rows = self.execute('get_book', (title, book_id))
             return rows.one()
+    # immutable fields of a book, read through the cache, None if the book does not exist
+    def get_book_info(self, title, book_id):
+        if self.book_cache is not None:
+            book_info = self.book_cache.get((title, book_id))
+            if book_info is not None:
+                return book_info
+        book = self.get_book(title, book_id)
+        if book is None:
+            return None
+        book_info = BookInfo(book.book_id, book.title, book.author)
+        if self.book_cache is not None:
+            self.book_cache.put((title, book_id), book_info)
+        return book_info
     def check_user_reserved_books(self, username):
-        query = SimpleStatement("SELECT reserved_books FROM users WHERE username = %s", consistency_level=ConsistencyLevel.TWO)
-        rows = self.session.execute(query, (username,))
+        rows = self.execute('check_user_reserved_books', (username,))
         return rows.one().reserved_books
-    def lock_book(self, book_id, title):
-        query = SimpleStatement("""
-            UPDATE books
-            SET available = false
-            WHERE book_id = %s AND title = %s
-            IF available = true
-            """, consistency_level=ConsistencyLevel.TWO)
-        try:
-            query_result = self.session.execute(query, (book_id, title))
-        except NoHostAvailable as e:
-            print(f"Error occurred: {e}")
+    # the pending lock is sent alongside the lock, it lands long before the Paxos round of the lock is over, so a lock
+    # whose reservation never gets written is found by the ReservationSweeper, and a lock whose pending lock could not
+    # be written is given back, a lock taken without a username is released by the sweeper once the grace period is over
+    def lock_book(self, book_id, title, username=None, reservation_id=None):
+        gate = self.book_gate
+        if gate is not None and gate.is_unavailable(book_id):
+            self.log("Book was unavailable moments ago")
             return False
-        if not query_result.one().applied:
+        reservation_id = reservation_id or uuid.uuid4()
+        with gate.lock_for(book_id) if gate is not None else contextlib.nullcontext():
+            # the caller ahead of us may have just taken the book
+            if gate is not None and gate.is_unavailable(book_id):
+                self.log("Book was unavailable moments ago")
+                return False
+            pending_row = pending_lock_row(book_id, title, username, reservation_id)
+            pending = self.execute_async('add_pending_lock', pending_row)
+            try:
+                applied = self.try_lock_book(book_id, title, username, reservation_id)
+            except NOT_APPLIED_ERRORS + UNCERTAIN_ERRORS as e:
+                print(f"Error occurred: {e}")
+                # the lock may have been applied, the sweeper needs its pending lock
+                self.wait_for_pending_lock(pending, pending_row)
+                return False
+            self.invalidate_title(title)
+            # applied or not, the book is reserved now
+            if gate is not None:
+                gate.mark_unavailable(book_id)
+        recorded = self.wait_for_pending_lock(pending, pending_row)
+        if not applied:
             self.log("Didn't manage to lock the book")
             return False
+        if not recorded:
+            self.give_back_unrecorded_lock(book_id, title, reservation_id)
+            return False
+        self.update_availability_index(title, book_id, False)
         return True
-    def unlock_book(self, book_id, title):
-        query = SimpleStatement("""
-            UPDATE books
-            SET available = true
-            WHERE book_id = %s AND title = %s
-            """, consistency_level=ConsistencyLevel.TWO)
-        query_result = self.session.execute(query, (book_id, title))
-        if not query_result.one().applied:
-            raise Exception("Failed to release lock on book. You shouldn't be seeing this message!")
-        return True   
-    def make_reservation(self, username, book_title, book_id, due_date_str):
-        if not self.check_username_exists(username):
+    # waits for a pending lock sent with execute_async and sends it again when it failed, returns whether it was written
+    def wait_for_pending_lock(self, future, pending_row):
+        try:
+            future.result()
+            return True
+        except NOT_APPLIED_ERRORS + UNCERTAIN_ERRORS:
+            return self.write_pending_lock(pending_row)
+    def write_pending_lock(self, pending_row):
+        try:
+            self.execute_with_retry('add_pending_lock', pending_row, retry_timeouts=True)
+            return True
+        except NOT_APPLIED_ERRORS + UNCERTAIN_ERRORS as e:
+            print(f"Error occurred: {e}")
+            return False
+    # nobody would find a lock without its pending lock if this process stopped now
+    def give_back_unrecorded_lock(self, book_id, title, reservation_id):
+        self.log("Didn't manage to record the lock of the book")
+        try:
+            self.unlock_book(book_id, title, reservation_id)
+        except NOT_APPLIED_ERRORS + UNCERTAIN_ERRORS as e:
+            print(f"Error occurred: {e}")
+    # retries the conditional update until its outcome is known, after a timeout a serial read of the lock
+    # tells whether the attempt was applied, since the lock carries the id of the reservation that took it
+    def try_lock_book(self, book_id, title, username, reservation_id, uncertain=False):
+        for attempt in range(self.retry_policy.max_attempts):
+            try:
+                if uncertain:
+                    lock = self.execute('get_book_lock', (title, book_id)).one()
+                    if lock is not None and lock.reservation_id == reservation_id:
+                        return True
+                    if lock is None or not lock.available:
+                        return False
+                    uncertain = False
+                return self.execute('lock_book', (username, reservation_id, book_id, title)).one().applied
+            except NOT_APPLIED_ERRORS as e:
+                error = e
+            except UNCERTAIN_ERRORS as e:
+                error = e
+                uncertain = True
+            if attempt == self.retry_policy.max_attempts - 1:
+                raise error
+            self.count_retry('lock_book')
+            self.retry_policy.backoff(attempt)
+    # with a reservation_id the book is unlocked only while that reservation still holds it
+    def unlock_book(self, book_id, title, reservation_id=None):
+        if reservation_id is None:
+            self.execute('unlock_book', (book_id, title))
+            released = True
+        else:
+            released = self.execute_with_retry('release_book', (book_id, title, reservation_id), retry_timeouts=True).one().applied
+        self.invalidate_title(title)
+        if self.book_gate is not None:
+            self.book_gate.mark_available(book_id)
+        if released:
+            self.update_availability_index(title, book_id, True)
+        return released   
+    # with a reservation_id the book is already locked for that reservation, e.g. by find_available_book(lock=True),
+    # and is unlocked again when the reservation cannot be made
+    def make_reservation(self, username, book_title, book_id, due_date_str, reservation_id=None):
+        locked = reservation_id is not None
+        def give_back():
+            if locked:
+                self.unlock_book(book_id, book_title, reservation_id)
+        try:
+            due_date = parse_due_date(due_date_str)
+        except ValueError:
+            give_back()
+            raise
+        # a single read of the user row answers both the existence and the limit check
+        user = self.get_user(username)
+        if user is None:
             self.log("User does not exist. Cannot make reservation.")
+            give_back()
             return False        
-        if self.check_user_reserved_books(username) >= self.max_reserved_books:
+        if user.reserved_books >= self.max_reserved_books:
             self.log("User has already reserved meximum number of books. Cannot make more reservations.")
+            give_back()
             return False
-        due_date = datetime.strptime(due_date_str, '%d.%m.%Y')
-        due_date = due_date.replace(tzinfo=timezone.utc)        
-        book = self.get_book(book_title, book_id)
-        if book:
-            if not book.available:
+        if not locked:
+            # every step is tagged with the reservation id, so a step that timed out can be told apart from a competitor
+            reservation_id = uuid.uuid4()
+            # Set book to unavailable, the conditional update is not applied for both a reserved and a missing book
+            if not self.lock_book(book_id, book_title, username, reservation_id):
                 self.log("Book is unavailable. Cannot make reservation.")
-                return False
-            # Set book to unavailable
-            if not self.lock_book(book_id, book_title):
                 return False   
-        else:
-            self.log("Book not found. You should not be seeing this message.")
-            return False
         # reserve user slot for a book
-        if not self.increment_user_reserved_books(username):
-            self.unlock_book(book_id, book_title)
-        query = SimpleStatement("""
-            INSERT INTO reservations (username, book_id, book_title, due_date)
-            VALUES (%s, %s, %s, %s)
-        """, consistency_level=ConsistencyLevel.TWO)
-        self.session.execute(query, (username, book_id, book_title, due_date))
-        #time.sleep(0.2)
-        self.log("Reservation made successfully!")
-        return True  
-    def get_user_reserved_books(self, username):
-        query = SimpleStatement("""
-                SELECT book_title, book_id, due_date
-                FROM reservations
-                WHERE username = %s
-        """, consistency_level=ConsistencyLevel.ONE)
-        rows = self.session.execute(query, (username,))
-        #print(rows._current_rows)
-        #print([(self.get_book(row.book_title, row.book_id), row.due_date) for row in rows._current_rows])
-        return [(self.get_book(row.book_title, row.book_id), row.due_date) for row in rows._current_rows]
-    # DOES NOT SUPPORT CONCURENT OPERATIONS, BUT NOT REQUIRED IN THE PROJECT
-    def finish_reservation(self, username, book_id, book_title):
-        # Check if the user exists
-        if not self.check_username_exists(username):
-            self.log("User does not exist. Cannot finish reservation. You should not be seeing this message.")
+        try:
+            slot_reserved = self.increment_user_reserved_books(username)
+        except NOT_APPLIED_ERRORS + UNCERTAIN_ERRORS as e:
+            print(f"Error occurred: {e}")
+            # a timed out increment may still have taken the slot
+            self.mark_user_to_reconcile(username)
+            slot_reserved = False
+        if not slot_reserved:
+            self.compensate_reservation(username, book_title, book_id, reservation_id)
             return False
-        
-        # Check if the book exists
-        book = self.get_book(book_title, book_id)
-        if not book:
-            self.log("Book not found. Cannot finish reservation. You should not be seeing this message.")
+        try:
+            recorded = self.record_reservations(username, [(book_title, book_id)], [reservation_id], due_date)
+        except NOT_APPLIED_ERRORS + UNCERTAIN_ERRORS as e:
+            print(f"Error occurred: {e}")
+            # the insert may have landed before it timed out
+            self.compensate_reservation(username, book_title, book_id, reservation_id, slot_reserved=True, due_date=due_date)
             return False
-        
-        # Check if the book is reserved by the user
-        query = SimpleStatement("""
-            SELECT *
-            FROM reservations
-            WHERE username = %s AND book_id = %s
-        """, consistency_level=ConsistencyLevel.ONE)
-        rows = self.session.execute(query, (username, book_id))
-        if not rows:
-            self.log("User has not reserved this book. Cannot finish reservation.")
+        if not recorded:
+            # the row in the way belongs to another reservation and stays
+            self.compensate_reservation(username, book_title, book_id, reservation_id, slot_reserved=True)
+            return False
+        self.log("Reservation made successfully!")
+        return True  
+    # writes the reservation rows and then their rows in reservations_by_due_date, one batch each, as the rows of one user
+    # and those of one due date share a partition, a timed out write is sent again: the conditional insert of the user's rows
+    # is applied all at once or not at all, and is not applied when an earlier attempt landed before it timed out, then the rows
+    # it returns carry our reservation ids, returns False when a row of another reservation of the same book is in the way
+    def record_reservations(self, username, books, reservation_ids, due_date):
+        reservation_rows = [(username, book_id, book_title, due_date, reservation_id) for (book_title, book_id), reservation_id in zip(books, reservation_ids)]
+        due_date_rows = [(due_date_bucket(due_date), due_date, username, book_id, book_title, reservation_id) for (book_title, book_id), reservation_id in zip(books, reservation_ids)]
+        ours = {book_id: reservation_id for (book_title, book_id), reservation_id in zip(books, reservation_ids)}
+        # a single reservation is sent as plain statements
+        def send(name, rows):
+            return self.execute_async(name, rows[0]) if len(rows) == 1 else self.execute_batch_async(name, rows)
+        def write():
+            rows = list(send('add_reservation', reservation_rows).result())
+            if not rows[0].applied and not all(ours.get(row.book_id) == row.reservation_id for row in rows):
+                self.log("A reservation of the book already exists. Cannot make reservation.")
+                return False
+            send('add_reservation_by_due_date', due_date_rows).result()
+            self.mark_due_date_bucket(due_date_bucket(due_date))
+            return True
+        return self.with_retry(write, retry_timeouts=True, name='record_reservations')
+    # written after the rows of reservations_by_due_date, so the ReservationSweeper dropping the bucket of an emptied day
+    # sees either the rows or the mark written after them
+    def mark_due_date_bucket(self, bucket):
+        if self.due_date_bucket_marked(bucket):
+            return
+        self.execute('add_due_date_bucket', (bucket,))
+        self.remember_due_date_bucket(bucket)
+    # a past day is always marked again, its mark may have been dropped since
+    def due_date_bucket_marked(self, bucket):
+        with self.marked_due_date_buckets_lock:
+            return bucket in self.marked_due_date_buckets and bucket >= due_date_bucket(datetime.now(timezone.utc))
+    def remember_due_date_bucket(self, bucket):
+        today = due_date_bucket(datetime.now(timezone.utc))
+        if bucket < today:
+            return
+        with self.marked_due_date_buckets_lock:
+            self.marked_due_date_buckets = {marked for marked in self.marked_due_date_buckets if marked >= today}
+            self.marked_due_date_buckets.add(bucket)
+    # due_date means the reservations were written, or may have been, with that due date
+    def compensate_reservation(self, username, book_title, book_id, reservation_id, slot_reserved=False, due_date=None):
+        self.compensate_reservations(username, [(book_title, book_id)], [reservation_id], int(slot_reserved), due_date)
+    # undoes the steps of failed reservations in reverse order, each step is safe to repeat,
+    # a step that fails stops the rest, and what is left behind is repaired by the ReservationSweeper
+    def compensate_reservations(self, username, books, reservation_ids, slots_reserved=0, due_date=None):
+        try:
+            if due_date is not None:
+                for book_title, book_id in books:
+                    self.execute_with_retry('delete_reservation', (username, book_id, book_title, due_date), retry_timeouts=True)
+                    self.execute_with_retry('delete_reservation_by_due_date', (due_date_bucket(due_date), due_date, username, book_id), retry_timeouts=True)
+            if slots_reserved:
+                self.decrement_user_reserved_books(username, slots_reserved)
+            for (book_title, book_id), reservation_id in zip(books, reservation_ids):
+                self.unlock_book(book_id, book_title, reservation_id)
+        except Exception as e:
+            print(f"Error occurred while undoing reservation: {e}")
+            self.mark_user_to_reconcile(username)
+    # reserves a basket of (title, book_id) books for one user: the user is read once, the books are locked concurrently,
+    # their slots are taken with one conditional update and their rows written with record_reservations,
+    # returns True or False for every book in the given order, books past the user's free slots are not locked at all
+    def make_reservations(self, username, books, due_date_str):
+        books = list(books)
+        results = [False] * len(books)
+        user = self.get_user(username)
+        if user is None:
+            self.log("User does not exist. Cannot make reservation.")
+            return results
+        if user.reserved_books >= self.max_reserved_books:
+            self.log("User has already reserved the maximum number of books.")
+            return results
+        due_date = parse_due_date(due_date_str)
+        candidates = books[:self.max_reserved_books - user.reserved_books]
+        reservation_ids = [uuid.uuid4() for _ in candidates]
+        locked = [i for i, applied in enumerate(self.lock_books(username, candidates, reservation_ids)) if applied]
+        if not locked:
+            return results
+        try:
+            taken = self.reserve_user_slots(username, len(locked), user.reserved_books)
+        except NOT_APPLIED_ERRORS + UNCERTAIN_ERRORS as e:
+            print(f"Error occurred: {e}")
+            self.mark_user_to_reconcile(username)
+            taken = 0
+        except Exception:
+            # the slots were not taken, every locked book is given back before the error is passed on
+            self.compensate_reservations(username, [books[i] for i in locked], [reservation_ids[i] for i in locked])
+            raise
+        reserved = locked[:taken]
+        if len(reserved) < len(locked):
+            self.compensate_reservations(username, [books[i] for i in locked[taken:]], [reservation_ids[i] for i in locked[taken:]])
+        if not reserved:
+            return results
+        try:
+            recorded = self.record_reservations(username, [books[i] for i in reserved], [reservation_ids[i] for i in reserved], due_date)
+        except NOT_APPLIED_ERRORS + UNCERTAIN_ERRORS as e:
+            print(f"Error occurred: {e}")
+            self.compensate_reservations(username, [books[i] for i in reserved], [reservation_ids[i] for i in reserved], len(reserved), due_date)
+            return results
+        except Exception:
+            self.compensate_reservations(username, [books[i] for i in reserved], [reservation_ids[i] for i in reserved], len(reserved), due_date)
+            raise
+        if not recorded:
+            self.compensate_reservations(username, [books[i] for i in reserved], [reservation_ids[i] for i in reserved], len(reserved))
+            return results
+        for i in reserved:
+            results[i] = True
+        self.log(f"Reserved {len(reserved)} of {len(books)} books")
+        return results
+    # sends every lock at once, each with its pending lock as lock_book does, a lock that failed with a retryable error
+    # is retried on its own through try_lock_book, a lock whose pending lock could not be written is given back
+    def lock_books(self, username, books, reservation_ids):
+        gate = self.book_gate
+        sent = []
+        for (title, book_id), reservation_id in zip(books, reservation_ids):
+            if gate is not None and gate.is_unavailable(book_id):
+                sent.append(None)
+                continue
+            pending_row = pending_lock_row(book_id, title, username, reservation_id)
+            sent.append((pending_row, self.execute_async('add_pending_lock', pending_row),
+                         self.execute_async('lock_book', (username, reservation_id, book_id, title))))
+        locked = []
+        for (title, book_id), reservation_id, futures in zip(books, reservation_ids, sent):
+            if futures is None:
+                locked.append(False)
+                continue
+            pending_row, pending, future = futures
+            try:
+                try:
+                    applied = future.result().one().applied
+                except NOT_APPLIED_ERRORS + UNCERTAIN_ERRORS as e:
+                    applied = self.try_lock_book(book_id, title, username, reservation_id, uncertain=isinstance(e, UNCERTAIN_ERRORS))
+            except NOT_APPLIED_ERRORS + UNCERTAIN_ERRORS as e:
+                print(f"Error occurred: {e}")
+                self.wait_for_pending_lock(pending, pending_row)
+                locked.append(False)
+                continue
+            self.invalidate_title(title)
+            if gate is not None:
+                gate.mark_unavailable(book_id)
+            recorded = self.wait_for_pending_lock(pending, pending_row)
+            if applied and not recorded:
+                self.give_back_unrecorded_lock(book_id, title, reservation_id)
+                applied = False
+            if applied:
+                self.update_availability_index(title, book_id, False)
+            locked.append(applied)
+        return locked
+    # retries errors after which the statement is known not to have been applied,
+    # timeouts only with retry_timeouts=True, for reads and statements that are safe to apply twice
+    def execute_with_retry(self, name, params, retry_timeouts=False):
+        return self.with_retry(lambda: self.execute(name, params), retry_timeouts, name)
+    # name is the operation the retries are counted under
+    def with_retry(self, attempt_fn, retry_timeouts=False, name='with_retry'):
+        for attempt in range(self.retry_policy.max_attempts):
+            try:
+                return attempt_fn()
+            except NOT_APPLIED_ERRORS:
+                if attempt == self.retry_policy.max_attempts - 1:
+                    raise
+            except UNCERTAIN_ERRORS:
+                if not retry_timeouts or attempt == self.retry_policy.max_attempts - 1:
+                    raise
+            self.count_retry(name)
+            self.retry_policy.backoff(attempt)
+    def count_retry(self, name):
+        with self.retries_lock:
+            self.retries[name] += 1
+    # called after a reserved_books update with an unknown outcome, before anything else is tried,
+    # if the row cannot be written either the user is only reconciled by this process
+    def mark_user_to_reconcile(self, username):
+        self.users_to_reconcile.add(username)
+        try:
+            self.execute_with_retry('add_user_to_reconcile', (username,), retry_timeouts=True)
+        except NOT_APPLIED_ERRORS + UNCERTAIN_ERRORS as e:
+            print(f"Error occurred: {e}")
+    # sets reserved_books to the number of the user's reservations, for users whose counter update had an unknown outcome,
+    # a reservation in progress between its increment and its insert is not counted, so the ReservationSweeper
+    # leaves users with one for a later sweep
+    def reconcile_user_reserved_books(self, username):
+        reserved_books = self.check_user_reserved_books(username)
+        count = len(list(self.execute('get_user_reservation_ids', (username,))))
+        if reserved_books == count:
             return False
+        return self.execute('set_user_reserved_books', (count, username, reserved_books)).one().applied
+    # returns Reservations with the BookInfo of the reserved book, with_books=False returns them without reading the books
+    def get_user_reserved_books(self, username, with_books=True):
+        rows = self.execute('get_user_reservations', (username,))
+        if not with_books:
+            return rows.current_rows
+        reservations = list(rows.current_rows)
+        for reservation in reservations:
+            if self.book_cache is not None:
+                reservation.book = self.book_cache.get((reservation.book_title, reservation.book_id))
+        # all book reads missing from the cache are in flight at once instead of one round trip per reservation
+        futures = [(reservation, self.execute_async('get_book', (reservation.book_title, reservation.book_id)))
+                   for reservation in reservations if reservation.book is None]
+        for reservation, future in futures:
+            book = future.result().one()
+            if book is not None:
+                reservation.book = BookInfo(book.book_id, book.title, book.author)
+                if self.book_cache is not None:
+                    self.book_cache.put((book.title, book.book_id), reservation.book)
+        return reservations
+    def finish_reservation(self, username, book_id, book_title, max_retries=30, max_backoff=0.05):
+        # the reservation is read first for its due date, which names the row of reservations_by_due_date to drop,
+        # the conditional delete then lets only one of the returns that read it through, it is not applied
+        # for a missing user, a book the user has not reserved or the wrong title, and returns the current due date
+        # to retry with when it changed meanwhile, or no columns at all when the reservation is gone by now
+        row = self.execute('get_reservation', (username, book_id)).one()
+        for attempt in range(max_retries):
+            if row is None or getattr(row, 'due_date', None) is None or row.book_title != book_title:
+                self.log("User has not reserved this book. Cannot finish reservation.")
+                return False
+            due_date = row.due_date
+            row = self.execute('delete_reservation', (username, book_id, book_title, due_date)).one()
+            if row.applied:
+                break
+            self.count_retry('finish_reservation')
+            time.sleep(random.uniform(0, min(max_backoff, 0.001 * 2 ** attempt)))
+        else:
+            raise Exception(f"Failed to finish the reservation of {username} after {max_retries} attempts.")
 
-        # LOCK
-        query = SimpleStatement("""
-            DELETE FROM reservations
-            WHERE username = %s AND book_id = %s
-        """, consistency_level=ConsistencyLevel.TWO)
-        self.session.execute(query, (username, book_id))
-        self.decrement_user_reserved_books(username)
-        
-        # Set the book as available
-        query = SimpleStatement("""
-            UPDATE books
-            SET available = true
-            WHERE book_id = %s AND title = %s
-        """, consistency_level=ConsistencyLevel.TWO)
-        self.session.execute(query, (book_id, book.title))
+        # Set the book as available while the user slot is released, the reservation is gone by now,
+        # so the book is given back whatever happens to the slot
+        futures = [self.execute_async('unlock_book', (book_id, book_title)),
+                   self.execute_async('delete_reservation_by_due_date', (due_date_bucket(due_date), due_date, username, book_id))]
+        try:
+            self.decrement_user_reserved_books(username)
+        except NOT_APPLIED_ERRORS + UNCERTAIN_ERRORS as e:
+            print(f"Error occurred: {e}")
+            # a timed out decrement may still have released the slot
+            self.mark_user_to_reconcile(username)
+        finally:
+            for future in futures:
+                future.result()
+            self.invalidate_title(book_title)
+            if self.book_gate is not None:
+                self.book_gate.mark_available(book_id)
+            self.update_availability_index(book_title, book_id, True)
         
-        print("Reservation finished!")
+        self.log("Reservation finished!")
         return True
     def increment_user_reserved_books(self, username):
-        query = SimpleStatement("UPDATE users SET reserved_books = reserved_books + 1 WHERE username = %s IF reserved_books < %s", consistency_level=ConsistencyLevel.TWO)
-        result = self.session.execute(query, (username, self.max_reserved_books))
+        result = self.execute_with_retry('increment_user_reserved_books', (username, self.max_reserved_books))
         if result.one().applied:
             self.log('books incermeted')
             return True
         else:
             self.log("Failed to increment reserved books. User has already reserved the maximum number of books.")
             return False
-    # DOES NOT SUPPORT CONCURENT OPERATIONS, BUT NOT REQUIRED IN THE PROJECT
-    def decrement_user_reserved_books(self, username):
+    # takes up to count slots with one conditional update, returns how many were taken,
+    # a lost race returns the current value to retry with after a jittered backoff
+    def reserve_user_slots(self, username, count, reserved_books=None, max_retries=30, max_backoff=0.05):
+        if reserved_books is None:
+            reserved_books = self.check_user_reserved_books(username)
+        for attempt in range(max_retries):
+            taken = min(count, self.max_reserved_books - reserved_books)
+            if taken <= 0:
+                self.log("Failed to reserve books. User has already reserved the maximum number of books.")
+                return 0
+            row = self.execute_with_retry('set_user_reserved_books', (reserved_books + taken, username, reserved_books)).one()
+            if row.applied:
+                return taken
+            reserved_books = row.reserved_books
+            self.count_retry('reserve_user_slots')
+            time.sleep(random.uniform(0, min(max_backoff, 0.001 * 2 ** attempt)))
+        raise Exception(f"Failed to reserve books for {username} after {max_retries} attempts.")
+    # compare-and-set on the value read, a lost race returns the current value to retry with after a jittered backoff
+    def decrement_user_reserved_books(self, username, count=1, max_retries=30, max_backoff=0.05):
         no_reserved_books = self.check_user_reserved_books(username)
-        decremented_reserved_books = no_reserved_books - 1
-        query = SimpleStatement("UPDATE users SET reserved_books = %s WHERE username = %s IF reserved_books > 0", consistency_level=ConsistencyLevel.TWO)
-        result = self.session.execute(query, (decremented_reserved_books, username,))
-        if not result.one().applied:
-            raise Exception("Trying to decrement reserved books below 0.")
-    def update_reservation_due_date(self, username, book_id, due_date_str):
-        due_date = datetime.strptime(due_date_str, '%d.%m.%Y')
-        due_date = due_date.replace(tzinfo=timezone.utc)
-        query = SimpleStatement("""
-            UPDATE reservations
-            SET due_date = %s
-            WHERE username = %s AND book_id = %s
-            IF EXISTS
-        """, consistency_level=ConsistencyLevel.TWO)
-        result = self.session.execute(query, (due_date, username, book_id))
-        if result.one().applied:
-            return True
-        return False
+        for attempt in range(max_retries):
+            if no_reserved_books is None or no_reserved_books < count:
+                raise Exception("Trying to decrement reserved books below 0.")
+            result = self.execute_with_retry('set_user_reserved_books', (no_reserved_books - count, username, no_reserved_books))
+            row = result.one()
+            if row.applied:
+                return True
+            no_reserved_books = row.reserved_books
+            self.count_retry('decrement_user_reserved_books')
+            time.sleep(random.uniform(0, min(max_backoff, 0.001 * 2 ** attempt)))
+        raise Exception(f"Failed to decrement reserved books of {username} after {max_retries} attempts.")
+    # the row of reservations_by_due_date for the new due date is written before the reservation is updated,
+    # so the reservation is never missing from it, a lost race on the due date is retried with the due date it returns
+    def update_reservation_due_date(self, username, book_id, due_date_str, max_retries=30, max_backoff=0.05):
+        due_date = parse_due_date(due_date_str)
+        new_bucket = due_date_bucket(due_date)
+        reservation = self.execute('get_reservation', (username, book_id)).one()
+        if reservation is None:
+            return False
+        old_due_date = reservation.due_date
+        for attempt in range(max_retries):
+            moved = old_due_date is None or _to_timestamp(old_due_date) != _to_timestamp(due_date)
+            if moved:
+                self.execute('add_reservation_by_due_date', (new_bucket, due_date, username, book_id, reservation.book_title, reservation.reservation_id))
+                self.mark_due_date_bucket(new_bucket)
+            row = self.execute('update_reservation_due_date', (due_date, username, book_id, old_due_date)).one()
+            if row.applied:
+                if moved and old_due_date is not None:
+                    self.execute('delete_reservation_by_due_date', (due_date_bucket(old_due_date), old_due_date, username, book_id))
+                return True
+            # a reservation gone by now returns no due date, the row written above is dropped
+            # unless the reservation is due on that date after all
+            current_due_date = getattr(row, 'due_date', None)
+            if moved and (current_due_date is None or _to_timestamp(current_due_date) != _to_timestamp(due_date)):
+                self.execute('delete_reservation_by_due_date', (new_bucket, due_date, username, book_id))
+            if current_due_date is None:
+                return False
+            old_due_date = current_due_date
+            self.count_retry('update_reservation_due_date')
+            time.sleep(random.uniform(0, min(max_backoff, 0.001 * 2 ** attempt)))
+        raise Exception(f"Failed to update the due date of {username}'s reservation after {max_retries} attempts.")
+    # reservations due before as_of, one list per day bucket, only the days in due_date_buckets are read, from the oldest
+    # on however long ago it was, skipping days emptied since, up to max_in_flight buckets are read ahead at once
+    def get_overdue_reservations(self, as_of=None, max_in_flight=8):
+        as_of = as_of if as_of is not None else datetime.now(timezone.utc)
+        futures = collections.deque()
+        for bucket in [row.bucket for row in self.execute('get_due_date_buckets', (due_date_bucket(as_of),))]:
+            futures.append(self.execute_async('get_reservations_due', (bucket, as_of)))
+            if len(futures) == max_in_flight:
+                rows = list(futures.popleft().result())
+                if rows:
+                    yield rows
+        while futures:
+            rows = list(futures.popleft().result())
+            if rows:
+                yield rows
+    # backfills reservations_by_due_date for reservations made before it existed, reads the whole reservations table once
+    def rebuild_due_date_index(self, page_size=500):
+        paging_state = None
+        while True:
+            rows, paging_state = self.execute_page('get_all_reservations', (), page_size, paging_state)
+            futures = [self.execute_async('add_reservation_by_due_date', (due_date_bucket(row.due_date), row.due_date, row.username, row.book_id, row.book_title, row.reservation_id))
+                       for row in rows if row.due_date is not None]
+            for future in futures:
+                future.result()
+            for bucket in {due_date_bucket(row.due_date) for row in rows if row.due_date is not None}:
+                self.mark_due_date_bucket(bucket)
+            if paging_state is None:
+                break
+# repairs what failed reservations leave behind: books locked by a reservation that has no row,
+# and reserved_books counters whose update had an unknown outcome, and drops the marks of days with no reservations left
+class ReservationSweeper():
+    # locks younger than grace_period seconds may belong to a reservation still in progress,
+    # a new sweeper starts with the oldest pending locks that have not expired
+    def __init__(self, db_manager, grace_period=300, page_size=500):
+        self.db_manager = db_manager
+        self.grace_period = grace_period
+        self.page_size = page_size
+        self.swept_until = int((time.time() - PENDING_LOCK_TTL) * 1000000)
+    def sweep(self):
+        return self.release_orphaned_books(), self.reconcile_users(), self.drop_empty_due_date_buckets()
+    # the pending locks taken from since up to until, in microseconds, one page at a time
+    def pending_lock_pages(self, since, until):
+        for bucket in range(pending_lock_bucket(since), pending_lock_bucket(until) + 1):
+            for shard in range(PENDING_LOCK_SHARDS):
+                paging_state = None
+                while True:
+                    rows, paging_state = self.db_manager.execute_page('get_pending_locks', (bucket, shard), self.page_size, paging_state)
+                    locks = [row for row in rows if since <= row.locked_at < until]
+                    if locks:
+                        yield locks
+                    if paging_state is None:
+                        break
+    # reads the pending locks taken since the last sweep that are older than the grace period, not the books,
+    # a lock is released if it still holds its book and its reservation was not written,
+    # a lock without a username has no reservation to look up, an attempt that did not lock the book is not applied
+    def release_orphaned_books(self):
+        db_manager = self.db_manager
+        cutoff = int((time.time() - self.grace_period) * 1000000)
+        released = 0
+        for locks in self.pending_lock_pages(self.swept_until, cutoff):
+            # the books of a whole page are read at once, only the attempts that still hold their book are looked up,
+            # and the orphans among them released at once
+            holders = [(lock, db_manager.execute_async('get_book_holder', (lock.title, lock.book_id))) for lock in locks]
+            held = [lock for lock, future in holders if any(row.reservation_id == lock.reservation_id for row in future.result())]
+            lookups = [(lock, db_manager.execute_async('get_reservation_id', (lock.reserved_by, lock.book_id)) if lock.reserved_by is not None else None)
+                       for lock in held]
+            reservations = [(lock, future.result().one() if future is not None else None) for lock, future in lookups]
+            orphans = [lock for lock, reservation in reservations if reservation is None or reservation.reservation_id != lock.reservation_id]
+            releases = [(lock, db_manager.execute_async('release_book', (lock.book_id, lock.title, lock.reservation_id))) for lock in orphans]
+            for lock, future in releases:
+                if future.result().one().applied:
+                    released += 1
+                    db_manager.invalidate_title(lock.title)
+                    if db_manager.book_gate is not None:
+                        db_manager.book_gate.mark_available(lock.book_id)
+                    db_manager.update_availability_index(lock.title, lock.book_id, True)
+        self.swept_until = max(self.swept_until, cutoff)
+        db_manager.log(f"Released {released} orphaned books")
+        return released
+    # the users marked by this process and those in the users_to_reconcile table, a user is unmarked once recounted,
+    # a user with a reservation in progress stays marked, recounting would take the slot of that reservation
+    def reconcile_users(self):
+        db_manager = self.db_manager
+        usernames = set(db_manager.users_to_reconcile) | {row.username for row in db_manager.execute('get_users_to_reconcile', ())}
+        in_progress = self.users_with_reservations_in_progress(usernames) if usernames else set()
+        reconciled = 0
+        for username in sorted(usernames - in_progress):
+            if db_manager.reconcile_user_reserved_books(username):
+                reconciled += 1
+            db_manager.users_to_reconcile.discard(username)
+            db_manager.execute('delete_user_to_reconcile', (username,))
+        return reconciled
+    # users with a lock younger than the grace period that still holds its book and has no reservation row yet
+    def users_with_reservations_in_progress(self, usernames):
+        db_manager = self.db_manager
+        now = int(time.time() * 1000000)
+        in_progress = set()
+        for locks in self.pending_lock_pages(now - int(self.grace_period * 1000000), now + 1):
+            for lock in locks:
+                if lock.reserved_by not in usernames or lock.reserved_by in in_progress:
+                    continue
+                holder = db_manager.execute('get_book_holder', (lock.title, lock.book_id)).one()
+                if holder is None or holder.reservation_id != lock.reservation_id:
+                    continue
+                reservation = db_manager.execute('get_reservation_id', (lock.reserved_by, lock.book_id)).one()
+                if reservation is None or reservation.reservation_id != lock.reservation_id:
+                    in_progress.add(lock.reserved_by)
+        return in_progress
+    # past days only, a day is read again once its mark is dropped, and marked again when a reservation came in meanwhile
+    def drop_empty_due_date_buckets(self):
+        db_manager = self.db_manager
+        dropped = 0
+        for row in db_manager.execute('get_due_date_buckets', (due_date_bucket(datetime.now(timezone.utc)) - 1,)):
+            if db_manager.execute('get_first_reservation_due', (row.bucket,)).one() is not None:
+                continue
+            db_manager.execute('delete_due_date_bucket', (row.bucket,))
+            if db_manager.execute('get_first_reservation_due', (row.bucket,)).one() is not None:
+                db_manager.mark_due_date_bucket(row.bucket)
+            else:
+                dropped += 1
+        return dropped
+    # sweeps every interval seconds until the returned event is set
+    def start(self, interval=60):
+        stopped = threading.Event()
+        def run():
+            while not stopped.wait(interval):
+                try:
+                    self.sweep()
+                except NOT_APPLIED_ERRORS + UNCERTAIN_ERRORS as e:
+                    print(f"Error occurred while sweeping: {e}")
+        threading.Thread(target=run, daemon=True).start()
+        return stopped
+
+def _set_future_result(future, result):
+    if not future.done():
+        future.set_result(result)
+def _set_future_exception(future, exception):
+    if not future.done():
+        future.set_exception(exception)
+
+# asyncio front end over the manager's session, many reservations share one event loop and no thread is started per request
+class AsyncDatabaseManager():
+    def __init__(self, db_manager):
+        self.db_manager = db_manager
+        self.max_reserved_books = db_manager.max_reserved_books
+    def log(self, message):
+        self.db_manager.log(message)
+    # resolves with the list of rows of the first page, callbacks fire on the driver's event loop thread
+    def execute(self, name, params):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        response_future = self.db_manager.execute_async(name, params)
+        response_future.add_callbacks(
+            lambda rows: loop.call_soon_threadsafe(_set_future_result, future, rows),
+            lambda exception: loop.call_soon_threadsafe(_set_future_exception, future, exception))
+        return future
+    # waits for the index write like the lock and unlock paths of the manager
+    async def index_availability(self, title, book_id, available):
+        name = 'add_available_book' if available else 'remove_available_book'
+        try:
+            await self.execute(name, (title, availability_shard(book_id), book_id))
+        except NOT_APPLIED_ERRORS + UNCERTAIN_ERRORS as e:
+            print(f"Error occurred while indexing the book: {e}")
+    # the steps of DatabaseManagerSingleton.make_reservation, sent without blocking the event loop, a step that fails
+    # goes through the same retries, serial read of the lock and compensation on a worker thread, as those block
+    async def make_reservation(self, username, book_title, book_id, due_date_str):
+        db_manager = self.db_manager
+        due_date = parse_due_date(due_date_str)
+        user_rows = await self.execute('get_user', (username,))
+        if not user_rows:
+            self.log("User does not exist. Cannot make reservation.")
+            return False
+        if user_rows[0].reserved_books >= self.max_reserved_books:
+            self.log("User has already reserved meximum number of books. Cannot make more reservations.")
+            return False
+        # the book gate only fails fast here, its locks would block the event loop
+        gate = db_manager.book_gate
+        if gate is not None and gate.is_unavailable(book_id):
+            self.log("Book was unavailable moments ago")
+            return False
+        reservation_id = uuid.uuid4()
+        # the book is not read first, the conditional update is not applied for both a reserved and a missing book,
+        # the pending lock is sent alongside it as in lock_book
+        pending_row = pending_lock_row(book_id, book_title, username, reservation_id)
+        pending, lock_rows = await asyncio.gather(self.execute('add_pending_lock', pending_row),
+                                                  self.execute('lock_book', (username, reservation_id, book_id, book_title)), return_exceptions=True)
+        recorded = not isinstance(pending, BaseException) or await asyncio.to_thread(db_manager.write_pending_lock, pending_row)
+        try:
+            if isinstance(lock_rows, NOT_APPLIED_ERRORS + UNCERTAIN_ERRORS):
+                applied = await asyncio.to_thread(db_manager.try_lock_book, book_id, book_title, username, reservation_id, isinstance(lock_rows, UNCERTAIN_ERRORS))
+            elif isinstance(lock_rows, BaseException):
+                raise lock_rows
+            else:
+                applied = lock_rows[0].applied
+        except NOT_APPLIED_ERRORS + UNCERTAIN_ERRORS as e:
+            print(f"Error occurred: {e}")
+            return False
+        db_manager.invalidate_title(book_title)
+        if gate is not None:
+            gate.mark_unavailable(book_id)
+        if not applied:
+            self.log("Book is unavailable. Cannot make reservation.")
+            return False
+        if not recorded:
+            await asyncio.to_thread(db_manager.give_back_unrecorded_lock, book_id, book_title, reservation_id)
+            return False
+        await self.index_availability(book_title, book_id, False)
+
+        try:
+            increment_rows = await self.execute('increment_user_reserved_books', (username, self.max_reserved_books))
+            slot_reserved = increment_rows[0].applied
+        except NOT_APPLIED_ERRORS:
+            # not applied, so it is safe to send again, with the retries of increment_user_reserved_books
+            try:
+                slot_reserved = await asyncio.to_thread(db_manager.increment_user_reserved_books, username)
+            except NOT_APPLIED_ERRORS + UNCERTAIN_ERRORS as e:
+                print(f"Error occurred: {e}")
+                await asyncio.to_thread(db_manager.mark_user_to_reconcile, username)
+                slot_reserved = False
+        except UNCERTAIN_ERRORS as e:
+            print(f"Error occurred: {e}")
+            # a timed out increment may still have taken the slot
+            await asyncio.to_thread(db_manager.mark_user_to_reconcile, username)
+            slot_reserved = False
+        if not slot_reserved:
+            self.log("Failed to increment reserved books. User has already reserved the maximum number of books.")
+            await asyncio.to_thread(db_manager.compensate_reservation, username, book_title, book_id, reservation_id)
+            return False
+
+        try:
+            insert_rows = await self.execute('add_reservation', (username, book_id, book_title, due_date, reservation_id))
+            if insert_rows[0].applied:
+                bucket = due_date_bucket(due_date)
+                await self.execute('add_reservation_by_due_date', (bucket, due_date, username, book_id, book_title, reservation_id))
+                if not db_manager.due_date_bucket_marked(bucket):
+                    await self.execute('add_due_date_bucket', (bucket,))
+                    db_manager.remember_due_date_bucket(bucket)
+                recorded = True
+            else:
+                recorded = None
+        except NOT_APPLIED_ERRORS + UNCERTAIN_ERRORS:
+            recorded = None
+        if recorded is None:
+            # sent again through record_reservations, which tells a row of this reservation from one of another
+            try:
+                recorded = await asyncio.to_thread(db_manager.record_reservations, username, [(book_title, book_id)], [reservation_id], due_date)
+            except NOT_APPLIED_ERRORS + UNCERTAIN_ERRORS as e:
+                print(f"Error occurred: {e}")
+                # the insert may have landed before it timed out
+                await asyncio.to_thread(db_manager.compensate_reservation, username, book_title, book_id, reservation_id, True, due_date)
+                return False
+        if not recorded:
+            # the row in the way belongs to another reservation and stays
+            await asyncio.to_thread(db_manager.compensate_reservation, username, book_title, book_id, reservation_id, True)
+            return False
+        self.log("Reservation made successfully!")
+        return True
+
+# runs front desk commands, the menu dialogs and batch jobs alike, a batch has one command per line with shell quoting:
+#   add-book "Dune" "Frank Herbert"
+#   add-user alice
+#   reserve alice "Dune" 20.06.2024 [book_id]
+#   prolong alice <book_id> 27.06.2024
+#   finish alice "Dune" <book_id>
+# reserve without a book id takes any available copy of the title
+class CommandRunner():
+    # command -> its arguments, optional ones in brackets, book ids are parsed as uuids
+    COMMANDS = {
+        'add-book': ('title', 'author'),
+        'add-user': ('username',),
+        'reserve': ('username', 'title', 'due_date', '[book_id]'),
+        'prolong': ('username', 'book_id', 'due_date'),
+        'finish': ('username', 'title', 'book_id'),
+    }
+    def __init__(self, db_manager, concurrency=8):
+        self.db_manager = db_manager
+        self.concurrency = concurrency
+    # (command, arguments) of a line, None for a blank line or a # comment
+    def parse(self, line):
+        words = shlex.split(line, comments=True)
+        if not words:
+            return None
+        name, args = words[0], words[1:]
+        if name not in self.COMMANDS:
+            raise Exception(f"Unknown command: {name}")
+        params = self.COMMANDS[name]
+        required = [param for param in params if not param.startswith('[')]
+        if not len(required) <= len(args) <= len(params):
+            raise Exception(f"Usage: {name} {' '.join(params)}")
+        try:
+            args = [uuid.UUID(arg) if param.strip('[]') == 'book_id' else arg for param, arg in zip(params, args)]
+        except ValueError:
+            raise Exception(f"Invalid book id in: {line.strip()}")
+        return name, args
+    def run_command(self, name, *args):
+        return getattr(self, '_' + name.replace('-', '_'))(*args)
+    # runs the commands of lines on concurrency worker threads and returns (line number, line, succeeded, error) in input order,
+    # commands go to a worker by username (title for add-book), so the commands of one user run in the order given,
+    # a reservation of a book added by the same batch may still overtake it
+    def run(self, lines):
+        results = []
+        queues = [queue.Queue(maxsize=100) for _ in range(self.concurrency)]
+        def work(commands):
+            while True:
+                item = commands.get()
+                if item is None:
+                    break
+                result, name, args = item
+                try:
+                    result[2] = bool(self.run_command(name, *args))
+                except Exception as e:
+                    result[3] = str(e)
+        workers = [threading.Thread(target=work, args=(commands,)) for commands in queues]
+        for worker in workers:
+            worker.start()
+        try:
+            for line_number, line in enumerate(lines, start=1):
+                try:
+                    command = self.parse(line)
+                except Exception as e:
+                    results.append([line_number, line.strip(), False, str(e)])
+                    continue
+                if command is None:
+                    continue
+                name, args = command
+                result = [line_number, line.strip(), False, None]
+                results.append(result)
+                queues[zlib.crc32(args[0].encode()) % self.concurrency].put((result, name, args))
+        finally:
+            for commands in queues:
+                commands.put(None)
+            for worker in workers:
+                worker.join()
+        return [tuple(result) for result in results]
+    def _add_book(self, title, author):
+        return self.db_manager.add_book(title, author)
+    def _add_user(self, username):
+        return self.db_manager.add_user(username)
+    def _reserve(self, username, title, due_date, book_id=None):
+        parse_due_date(due_date)
+        if book_id is not None:
+            return self.db_manager.make_reservation(username, title, book_id, due_date)
+        # the copy is locked as it is found, so no other reservation can take it in between
+        reservation_id = uuid.uuid4()
+        book_id = self.db_manager.find_available_book(title, lock=True, username=username, reservation_id=reservation_id)
+        if book_id is None:
+            return False
+        return self.db_manager.make_reservation(username, title, book_id, due_date, reservation_id)
+    def _prolong(self, username, book_id, due_date):
+        return self.db_manager.update_reservation_due_date(username, book_id, due_date)
+    def _finish(self, username, title, book_id):
+        return self.db_manager.finish_reservation(username, book_id, title)
+
+# every dialog returns to the loop in show_menu, retries loop within the dialog
 class MenuDialogSingleton:
     _instance = None
     def __new__(cls, *args, **kwargs):
@@ -408,15 +2864,19 @@ class MenuDialogSingleton:
         return cls._instance
     def _initialize(self, db_manager):
         self.db_manager = db_manager       
+        self.commands = CommandRunner(db_manager)
     def show_menu(self):
-        print("Menu:")
-        print("1. Add a book")
-        print("2. Add a new user")
-        print("3. Search for a book")
-        print("4. View user's reservations")
-        print("5. Exit")
-        choice = input("Enter your choice: ")
-        self.process_choice(choice)
+        while True:
+            print("Menu:")
+            print("1. Add a book")
+            print("2. Add a new user")
+            print("3. Search for a book")
+            print("4. View user's reservations")
+            print("5. Exit")
+            choice = input("Enter your choice: ")
+            if not self.process_choice(choice):
+                return
+    # returns False once the user chose to exit
     def process_choice(self, choice):
         if choice == "1":
             self.add_book_dialog()
@@ -428,17 +2888,17 @@ class MenuDialogSingleton:
             self.search_user_dialog()
         elif choice == "5":
             print("Exiting program...")
-            return
+            return False
         else:
             print("Invalid choice. Please try again.")
-        self.show_menu()
+        return True
     def add_book_dialog(self):
         title = input("Enter the title of the book: ")
         author = input("Enter the author of the book: ")
         confirm = input("Press Y to confirm or any other key to cancel: ")
         if confirm.upper() != "Y":
             return
-        self.db_manager.add_book(title, author)
+        self.commands.run_command('add-book', title, author)
         print("Book added successfully!")
         return
     def add_user_dialog(self):
@@ -446,59 +2906,65 @@ class MenuDialogSingleton:
         confirm = input("Press Y to confirm or any other key to cancel: ")
         if confirm.upper() != "Y":
             return
-        self.db_manager.add_user(username)
+        self.commands.run_command('add-user', username)
         return    
     def make_reservation_dialog(self, book_id, book_title):
-        username = input("Enter a username to make reservation: ")
         while True:
-            due_date = input("Enter the due date of the reservation (dd.mm.yyyy): ")
-            try:
-                datetime.strptime(due_date, "%d.%m.%Y")
-                break
-            except ValueError:
-                print("Invalid date format. Please try again.")
-        if self.db_manager.make_reservation(username, book_title, book_id, due_date):
-            return
-        aborting = input("Reservation failed. Press N to return to main menu, or any other key to try again: ")
-        if aborting.upper() == "N":
-            return
-        self.make_reservation_dialog(book_id, book_title)
+            username = input("Enter a username to make reservation: ")
+            while True:
+                due_date = input("Enter the due date of the reservation (dd.mm.yyyy): ")
+                try:
+                    datetime.strptime(due_date, "%d.%m.%Y")
+                    break
+                except ValueError:
+                    print("Invalid date format. Please try again.")
+            if self.commands.run_command('reserve', username, book_title, due_date, book_id):
+                return
+            aborting = input("Reservation failed. Press N to return to main menu, or any other key to try again: ")
+            if aborting.upper() == "N":
+                return
     # TODO display also by whom the book is reserved
     def search_book_dialog(self):
-        search_term = input("Enter the title of the book: ")
-        books = self.db_manager.get_books_by_title(search_term)
-        
-        if len(books) > 10:
-            print(f"Matching books: {len(books)} books found.")
-            proceed = input("Do you want to proceed? (Y/N): ")
-            if proceed.upper() != "Y":
+        while True:
+            search_term = input("Enter the beginning of the title of the book: ")
+            pages = []
+            shown = 0
+            # matching books are fetched and shown 10 at a time, the pages shown are kept undecoded
+            for page, cursor in self.db_manager.search_books(search_term, page_size=10):
+                if not pages:
+                    print("Matching books:")
+                for i, book in enumerate(page, start=shown):
+                    if book.available:
+                        print(f"{i+1}. {book.title} by {book.author} [Available], ID: {book.book_id}")
+                    else:
+                        print(f"{i+1}. {book.title} by {book.author} [Reserved], ID: {book.book_id}")
+                pages.append(page)
+                shown += len(page)
+                if cursor is None:
+                    break
+                more = input("Press M to show more books or any other key to continue: ")
+                if more.upper() != "M":
+                    break
+            
+            if not pages:
+                print("No matching books found.")
                 return
-        
-        if books:
-            print("Matching books:")
-            for i, book in enumerate(books):
-                if book.available:
-                    print(f"{i+1}. {book.title} by {book.author} [Available], ID: {book.book_id}")
-                else:
-                    print(f"{i+1}. {book.title} by {book.author} [Reserved], ID: {book.book_id}")
-                """
-                    reserved_by = self.db_manager.check_user_reserved_books(book.reserved_by)
-                    print(f"{i+1}. {book.title} by {book.author} [Reserved by: {reserved_by}], ID: {book.book_id}")
-                """
             book_index = input("Enter the index of the book you wish to reserve, or N to cancel:")
             if book_index.upper() == "N":
                 return
             book_index = int(book_index)
-            if book_index < 1 or book_index > len(books):
+            if book_index < 1 or book_index > shown:
                 print("Invalid book index. Please try again.")
-                self.search_book_dialog()
-                return
-            book_id = books[book_index-1].book_id
-            book_title = books[book_index-1].title
-            self.make_reservation_dialog(book_id, book_title)
-        else:
-            print("No matching books found.")
-        return     
+                continue
+            # only the chosen book is decoded again
+            index = book_index - 1
+            for page in pages:
+                if index < len(page):
+                    book = page[index]
+                    break
+                index -= len(page)
+            self.make_reservation_dialog(book.book_id, book.title)
+            return
     def search_user_dialog(self):
         username = input("Enter the username: ")
         if not self.db_manager.check_username_exists(username):
@@ -515,17 +2981,20 @@ class MenuDialogSingleton:
                 break
             except ValueError:
                 print("Invalid date format. Please try again.")
-        if self.db_manager.update_reservation_due_date(username, book_id, due_date):
+        if self.commands.run_command('prolong', username, book_id, due_date):
             print("Reservation prolonged successfully!")
         else:
             print("Reservation prolongation failed.")
         return
     def view_user_reservations(self, username):
-        reservations = self.db_manager.get_user_reserved_books(username)
-        if reservations:
+        while True:
+            reservations = self.db_manager.get_user_reserved_books(username)
+            if not reservations:
+                print(f"No reservations found for user {username}.")
+                return
             print(f"Reservations for user {username}:")
-            for i, book in enumerate(reservations):
-                print(f"{i+1}. {book[0].title} by {book[0].author}, ID: {book[0].book_id}, Due date: {book[1]}")
+            for i, reservation in enumerate(reservations):
+                print(f"{i+1}. {reservation.book.title} by {reservation.book.author}, ID: {reservation.book_id}, Due date: {reservation.due_date}")
             
             reservation_index = input("Enter the index of the reservation you wish to select, or N to cancel:")
             if reservation_index.upper() == "N":
@@ -533,20 +3002,16 @@ class MenuDialogSingleton:
             reservation_index = int(reservation_index)
             if reservation_index < 1 or reservation_index > len(reservations):
                 print("Invalid reservation index. Please try again.")
-                self.view_user_reservations(username)
-                return
-            book_id = reservations[reservation_index-1][0].book_id
-            book_title = reservations[reservation_index-1][0].title
+                continue
+            book_id = reservations[reservation_index-1].book_id
+            book_title = reservations[reservation_index-1].book_title
             choice = input("Press F to finish the reservation, P to prolong it or any other key to cancel: ")
             if choice.upper() == "F":
-                self.db_manager.finish_reservation(username, book_id, book_title)
+                if self.commands.run_command('finish', username, book_title, book_id):
+                    print("Reservation finished!")
             elif choice.upper() == "P":
                 self.prolong_reservation_dialog(username, book_id)
-            else:
-                return
-        else:
-            print(f"No reservations found for user {username}.")
-        return
+            return
 
 if __name__ == "__main__":
     unittest.main()
@@ -558,4 +3023,5 @@ if __name__ == "__main__":
     db_manager.reset_tables()
     menu_dialog = MenuDialogSingleton(db_manager)
     #print('Menu dialog initialized')
-    menu_dialog.show_menu()
\ No newline at end of file
+    menu_dialog.show_menu()
+    CassandraBackend.shutdown_shared()
\ No newline at end of file